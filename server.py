@@ -19,16 +19,876 @@ from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
 from http.server import HTTPServer
 import argparse
+import asyncio
 import base64
+import collections
+import concurrent.futures
+import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
 import io
 import os
-import queue
+import re
+import select
+import shutil
+import signal
 import socket
+import stat
 import sys
+import tarfile
 import time
 import threading
 import urllib
+import uuid
+import zipfile
+import zlib
+
+
+class ServerOptions:
+
+    ''' Tunable behavior of the request handlers. A single instance is shared
+        by all listener threads.
+    '''
+
+    def __init__(self):
+        self.use_sendfile = True
+        # Requests asking for more ranges than this get the full file
+        self.max_ranges = 64
+        # If set, HTTP/1.1 is used and connections are kept open between
+        # requests
+        self.keep_alive = False
+        # The number of requests served over a single connection
+        self.max_keep_alive_requests = 100
+        # The number of seconds to wait for the next request, or for a
+        # transfer to make progress, before closing the connection. None
+        # waits indefinitely.
+        self.idle_timeout = 30
+        # The size of the per-thread buffer used to copy request bodies
+        self.upload_buffer_size = 1024 * 1024
+        # If set, uploads are written to a temporary file which then replaces
+        # the destination
+        self.atomic_put = False
+        # If set, the SHA-256 digest of each uploaded file is stored in an
+        # extended attribute and returned in the Digest header
+        self.store_digests = False
+        # When uploaded data is synced to disk: 'none', 'file' or 'file+dir'
+        self.fsync_policy = 'none'
+        # The maximum total size of cached directory listings in bytes. 0
+        # disables the cache.
+        self.listing_cache_size = 0
+        # The maximum total size of cached files in bytes and the maximum size
+        # of a single cached file. 0 disables the cache.
+        self.file_cache_size = 0
+        self.file_cache_max_file_size = 64 * 1024
+        # If set, files are served from precompressed .br, .zst or .gz
+        # siblings that are not older than the file when the client accepts
+        # the encoding
+        self.precompressed = False
+        # If set, files of at most compress_max_file_size bytes are gzipped
+        # on the fly. The results are kept in a cache of compress_cache_size
+        # bytes.
+        self.compress = False
+        self.compress_max_file_size = 1024 * 1024
+        self.compress_cache_size = 16 * 1024 * 1024
+        # The interval in seconds between logging cache statistics. None
+        # disables logging.
+        self.stats_interval = None
+        # The maximum number of log records waiting to be written and what
+        # happens to new records when that many are queued: 'block' or 'drop'
+        self.log_queue_size = 64 * 1024
+        self.log_overflow = 'block'
+        # The size of the log file write buffer. The log is flushed at least
+        # each time this many bytes have been written.
+        self.log_buffer_size = 64 * 1024
+        # The --log file is rotated once it grows beyond log_max_size bytes
+        # or is older than log_rotate_interval seconds. None disables either
+        # condition. At most log_backup_count rotated segments are kept and
+        # they are gzipped if log_compress is set.
+        self.log_max_size = None
+        self.log_rotate_interval = None
+        self.log_backup_count = 5
+        self.log_compress = False
+        # If set, an access log with one JSON object per request is appended
+        # to this file
+        self.access_log_path = None
+        # The interval in seconds between checks whether the access
+        # configuration file has changed. None reloads it only on SIGHUP.
+        self.access_config_poll_interval = None
+
+
+default_server_options = ServerOptions()
+
+thread_buffers = threading.local()
+
+
+class CountingWriter:
+
+    ''' Forwards writes to a file object and counts the written bytes '''
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes_written = 0
+
+    def write(self, data):
+        written = self.file.write(data)
+        self.bytes_written += written
+        return written
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+
+def format_access_record(record):
+    ''' Formats a tuple queued by SimpleHTTPFileServer.log_access() as a JSON
+        line
+    '''
+    (timestamp, client, method, path, status, user, bytes_in, bytes_out,
+     ttfb, duration) = record
+    timestamp = datetime.datetime.fromtimestamp(timestamp,
+                                                datetime.timezone.utc)
+    return json.dumps({
+        'time': timestamp.isoformat(timespec='milliseconds'),
+        'client': client,
+        'method': method,
+        'path': path,
+        'status': status,
+        'user': user,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'ttfb': round(ttfb, 6) if ttfb is not None else None,
+        'duration': round(duration, 6),
+    }) + '\n'
+
+
+# Content codings of precompressed files in the order of preference
+PRECOMPRESSED_SUFFIXES = [('br', '.br'), ('zstd', '.zst'), ('gzip', '.gz')]
+
+
+def parse_accept_encoding(header):
+    ''' Returns a dict mapping the content codings listed in an
+        Accept-Encoding header value to their quality values
+    '''
+    accepted = {}
+    if header is None:
+        return accepted
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        name, _, value = params.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+    if 'x-gzip' in accepted and 'gzip' not in accepted:
+        accepted['gzip'] = accepted['x-gzip']
+    return accepted
+
+
+def accepts_encoding(accepted, coding):
+    return accepted.get(coding, accepted.get('*', 0)) > 0
+
+
+def gzip_chunks(chunks, level=6):
+    ''' Compresses an iterable of bytes objects with gzip. The output is
+        flushed after each input chunk, so data is sent as soon as it is
+        produced.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def get_thread_buffer(size):
+    ''' Returns a memoryview of the given size into a buffer that is allocated
+        once per thread and reused by subsequent calls.
+    '''
+    buf = getattr(thread_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = bytearray(size)
+        thread_buffers.buf = buf
+    return memoryview(buf)[:size]
+
+
+class ChunkedReader:
+
+    ''' A read-only file object that decodes a body sent with the chunked
+        transfer coding. Raises EOFError if the underlying file ends before the
+        last chunk and ValueError if the body is malformed.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self.remaining = 0
+        self.finished = False
+
+    def _read_line(self):
+        line = self.file.readline(65537)
+        if not line.endswith(b'\n'):
+            raise EOFError('Incomplete chunked body')
+        return line
+
+    def _start_chunk(self):
+        size = self._read_line().split(b';', 1)[0].strip()
+        if not size or any(c not in b'0123456789abcdefABCDEF' for c in size):
+            raise ValueError('Invalid chunk size')
+        self.remaining = int(size, 16)
+        if self.remaining == 0:
+            # skip the trailer
+            while self._read_line().strip():
+                pass
+            self.finished = True
+
+    def readinto(self, b):
+        if self.finished:
+            return 0
+        if self.remaining == 0:
+            self._start_chunk()
+            if self.finished:
+                return 0
+
+        view = memoryview(b)[:self.remaining]
+        read = self.file.readinto(view)
+        if not read:
+            raise EOFError('Incomplete chunked body')
+        self.remaining -= read
+        if self.remaining == 0 and self._read_line().strip():
+            raise ValueError('Missing chunk terminator')
+        return read
+
+
+class LimitedReader:
+
+    ''' A read-only file object that reads at most length bytes from file,
+        counts them and feeds them to the given hash objects. If length is
+        None, file is read until its end. Raises EOFError if file ends before
+        length bytes have been read.
+    '''
+
+    def __init__(self, file, length=None, hashers=()):
+        self.file = file
+        self.remaining = length
+        self.count = 0
+        self.hashers = hashers
+
+    def readinto(self, b):
+        view = memoryview(b)
+        if self.remaining is not None:
+            if self.remaining == 0:
+                return 0
+            view = view[:self.remaining]
+        read = self.file.readinto(view)
+        if not read:
+            if self.remaining:
+                raise EOFError('Expected {0} more bytes'.format(
+                    self.remaining))
+            return 0
+        self.count += read
+        if self.remaining is not None:
+            self.remaining -= read
+        for hasher in self.hashers:
+            hasher.update(view[:read])
+        return read
+
+    def read(self, size):
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+
+class StreamedBody:
+
+    ''' A response body that is produced by an iterator of bytes objects while
+        it is being sent. If chunked is set, the data is framed using the
+        chunked transfer coding. close_callback releases any resources the
+        iterator uses even if it has never been started.
+    '''
+
+    def __init__(self, chunks, close_callback=None):
+        self.chunks = chunks
+        self.close_callback = close_callback
+        self.chunked = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            if self.chunked:
+                yield b''.join([
+                    '{0:x}\r\n'.format(len(chunk)).encode('ascii'),
+                    chunk, b'\r\n'])
+            else:
+                yield chunk
+        if self.chunked:
+            yield b'0\r\n\r\n'
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        if self.close_callback is not None:
+            self.close_callback()
+
+
+def encode_listing(entries, chunk_size=64*1024):
+    ''' Encodes an iterable of (name, type) tuples as a JSON object and yields
+        the result in pieces of roughly chunk_size bytes. The output is the
+        same as that of json.dumps() for a dict with the same items.
+    '''
+    parts = ['{']
+    size = 0
+    separator = ''
+    for name, file_type in entries:
+        part = '{0}{1}: "{2}"'.format(
+            separator, json.encoder.encode_basestring_ascii(name), file_type)
+        separator = ', '
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    parts.append('}')
+    yield ''.join(parts).encode('utf-8')
+
+
+class StatValidatedCache:
+
+    ''' A bounded LRU cache of values derived from files or directories. Each
+        entry is validated against the inode, size and modification time of
+        its path, so one stat() call is enough to reuse it. The total size of
+        the values is limited to max_size bytes.
+    '''
+
+    # Paths modified more recently than this are not cached, as further
+    # modifications within the timestamp granularity would go unnoticed
+    min_age = 1
+    name = 'cache'
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_validator(st):
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, path, st):
+        path = os.path.normpath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != self.make_validator(st):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def put(self, path, st, value, size):
+        if size > self.max_size or \
+                time.time() - st.st_mtime < self.min_age:
+            return
+        path = os.path.normpath(path)
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = (self.make_validator(st), value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+
+    def invalidate(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            self._remove(path)
+
+    def stats(self):
+        with self.lock:
+            return '{0}: {1} hits, {2} misses, {3} entries, ' \
+                '{4} bytes'.format(self.name, self.hits, self.misses,
+                                   len(self.entries), self.size)
+
+
+class ListingCache(StatValidatedCache):
+
+    ''' A cache of encoded directory listings '''
+
+    name = 'listing cache'
+
+    def record(self, path, st, chunks):
+        ''' Yields the given chunks and caches their concatenation once all of
+            them have been produced.
+        '''
+        parts = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if parts is not None:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > self.max_size:
+                    parts = None
+        if parts is not None:
+            self.put(path, st, b''.join(parts), size)
+
+
+CachedFile = collections.namedtuple(
+    'CachedFile', ['body', 'etag', 'last_modified', 'mtime', 'digest'])
+
+
+class CompressedFileCache(StatValidatedCache):
+
+    ''' A cache of gzipped files. Files that do not compress well are
+        remembered too, so that they are not compressed again.
+    '''
+
+    name = 'compressed file cache'
+
+    # The approximate memory used by an entry in addition to its data
+    entry_overhead = 256
+
+
+class FileCache(StatValidatedCache):
+
+    ''' A cache of the contents and validators of files of at most
+        max_file_size bytes
+    '''
+
+    name = 'file cache'
+
+    def __init__(self, max_size, max_file_size):
+        super().__init__(max_size)
+        self.max_file_size = max_file_size
+
+
+def encode_ndjson(rows, chunk_size=64*1024):
+    ''' Encodes each of the given rows as JSON on a separate line and yields
+        the result in pieces of roughly chunk_size bytes.
+    '''
+    parts = []
+    size = 0
+    for row in rows:
+        part = json.dumps(row) + '\n'
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    yield ''.join(parts).encode('utf-8')
+
+
+def _read_archived_file(f, size, chunk_size):
+    # exactly size bytes are returned even if the file has changed meanwhile
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            data = bytes(min(chunk_size, remaining))
+        remaining -= len(data)
+        yield data
+
+
+def encode_tar(entries, chunk_size=64*1024):
+    ''' Yields a tar archive of an iterable of (name, type, path) tuples in
+        pieces of roughly chunk_size bytes. The files are read while the
+        archive is being sent. Entries that can not be opened are skipped.
+    '''
+    parts = []
+    size = 0
+    written = 0
+    for name, file_type, path in entries:
+        info = tarfile.TarInfo(name)
+        if file_type == 'directory':
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            info.type = tarfile.DIRTYPE
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.mtime = int(st.st_mtime)
+            tail = info.tobuf(tarfile.PAX_FORMAT)
+        else:
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                continue
+            with f:
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                info.size = st.st_size
+                info.mode = stat.S_IMODE(st.st_mode)
+                info.mtime = int(st.st_mtime)
+                parts.append(info.tobuf(tarfile.PAX_FORMAT))
+                size += len(parts[-1])
+                for data in _read_archived_file(f, st.st_size, chunk_size):
+                    parts.append(data)
+                    size += len(data)
+                    if size >= chunk_size:
+                        written += size
+                        yield b''.join(parts)
+                        parts = []
+                        size = 0
+            # the data is padded to a whole number of blocks
+            tail = bytes(-st.st_size % tarfile.BLOCKSIZE)
+
+        parts.append(tail)
+        size += len(tail)
+        if size >= chunk_size:
+            written += size
+            yield b''.join(parts)
+            parts = []
+            size = 0
+
+    written += size + 2 * tarfile.BLOCKSIZE
+    parts.append(bytes(2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE))
+    yield b''.join(parts)
+
+
+class _ArchiveSink:
+
+    ''' A write-only, unseekable file object that collects the output of
+        zipfile until it is taken by the generator that sends it.
+    '''
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _zip_date_time(mtime):
+    return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def encode_zip(entries, chunk_size=64*1024):
+    ''' Yields a zip archive of an iterable of (name, type, path) tuples.
+        Since the output is not seekable, the sizes and checksums of files
+        follow their data. Entries that can not be opened are skipped.
+    '''
+    sink = _ArchiveSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, file_type, path in entries:
+            if file_type == 'directory':
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                info = zipfile.ZipInfo(name + '/',
+                                       _zip_date_time(st.st_mtime))
+                info.external_attr = (st.st_mode & 0xFFFF) << 16 | 0x10
+                archive.writestr(info, b'')
+                yield sink.take()
+                continue
+
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                continue
+            with f:
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                info = zipfile.ZipInfo(name, _zip_date_time(st.st_mtime))
+                info.external_attr = (st.st_mode & 0xFFFF) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = st.st_size
+                with archive.open(info, 'w') as out:
+                    for data in _read_archived_file(f, st.st_size,
+                                                    chunk_size):
+                        out.write(data)
+                        yield sink.take()
+                yield sink.take()
+    yield sink.take()
+
+
+def make_temp_upload_path(path):
+    dirname, filename = os.path.split(path)
+    return os.path.join(dirname, '.{0}.{1}.tmp'.format(
+        filename, uuid.uuid4().hex))
+
+
+class UploadBatch:
+
+    ''' The files of a bulk upload. Each file is written to a temporary file
+        next to its destination. commit() moves all of them into place at
+        once, while rollback() removes them along with the directories that
+        have been created for them.
+    '''
+
+    def __init__(self):
+        self.known_dirs = set()
+        self.created_dirs = []
+        self.staged = []
+        self.committed = 0
+
+    def make_dirs(self, path):
+        ''' Creates path and its missing parents. Each directory is checked
+            at most once per batch.
+        '''
+        if path in self.known_dirs:
+            return
+        if not os.path.isdir(path):
+            self.make_dirs(os.path.dirname(path))
+            os.mkdir(path)
+            self.created_dirs.append(path)
+        self.known_dirs.add(path)
+
+    def open(self, path):
+        ''' Returns a file descriptor of a new temporary file that replaces
+            path on commit.
+        '''
+        if os.path.isdir(path):
+            raise IsADirectoryError('Is a directory: ' + path)
+        write_path = make_temp_upload_path(path)
+        fd = os.open(write_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        self.staged.append((write_path, path))
+        return fd
+
+    def paths(self):
+        return [path for write_path, path in self.staged]
+
+    def commit(self, should_fsync_dirs=False):
+        for write_path, path in self.staged[self.committed:]:
+            os.replace(write_path, path)
+            self.committed += 1
+        if should_fsync_dirs:
+            for path in set(os.path.dirname(path) for path in
+                            self.paths() + self.created_dirs):
+                fsync_directory(path)
+
+    def rollback(self):
+        for write_path, path in self.staged[self.committed:]:
+            try:
+                os.remove(write_path)
+            except OSError:
+                pass
+        del self.staged[self.committed:]
+        for path in reversed(self.created_dirs):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+        self.created_dirs = []
+
+
+ARCHIVE_FORMATS = {
+    'tar': ('application/x-tar', encode_tar),
+    'tar.gz': ('application/gzip',
+               lambda entries: gzip_chunks(encode_tar(entries))),
+    'zip': ('application/zip', encode_zip),
+}
+
+
+DIGEST_ALGORITHMS = {'md5': 'md5', 'sha': 'sha1', 'sha-256': 'sha256',
+                     'sha-512': 'sha512'}
+
+DIGEST_XATTR = 'user.sha256'
+
+
+class DigestMismatchError(ValueError):
+    ''' Raised if a request body does not match its announced digest '''
+
+
+def parse_expected_digests(headers):
+    ''' Returns a list of (hashlib algorithm, digest) tuples announced for
+        the request body by the Content-MD5, Digest and X-Checksum-Sha256
+        headers. Unsupported Digest algorithms are ignored. Raises ValueError
+        if a header is malformed.
+    '''
+    expected = []
+    value = headers.get('Content-MD5')
+    if value is not None:
+        expected.append(('md5', base64.b64decode(value.strip(),
+                                                 validate=True)))
+    for header in headers.get_all('Digest', []):
+        for item in header.split(','):
+            if not item.strip():
+                continue
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise ValueError('Malformed Digest header')
+            algorithm = DIGEST_ALGORITHMS.get(name.strip().lower())
+            if algorithm is not None:
+                expected.append((algorithm, base64.b64decode(value.strip(),
+                                                             validate=True)))
+    value = headers.get('X-Checksum-Sha256')
+    if value is not None:
+        expected.append(('sha256', bytes.fromhex(value.strip())))
+    return expected
+
+
+def make_hashers(expected, should_store):
+    ''' Returns a dict of the hash objects needed to verify the expected
+        digests and, if should_store is set, to store the SHA-256 digest.
+    '''
+    algorithms = set(algorithm for algorithm, digest in expected)
+    if should_store:
+        algorithms.add('sha256')
+    return {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+
+def check_digests(hashers, expected):
+    for algorithm, digest in expected:
+        if hashers[algorithm].digest() != digest:
+            raise DigestMismatchError('{0} digest mismatch'.format(algorithm))
+
+
+def store_digest(fd, digest):
+    ''' Stores the hex SHA-256 digest of the file open as fd along with its
+        size and modification time, which are checked by load_digest(). Does
+        nothing if the file system does not support extended attributes.
+    '''
+    st = os.fstat(fd)
+    value = '{0} {1} {2}'.format(digest, st.st_size, st.st_mtime_ns)
+    try:
+        os.setxattr(fd, DIGEST_XATTR, value.encode('ascii'))
+    except (AttributeError, OSError):
+        pass
+
+
+def load_digest(fd, st):
+    ''' Returns the hex SHA-256 digest stored for the file open as fd or
+        None if there is none or the file has changed since it was stored.
+    '''
+    try:
+        value = os.getxattr(fd, DIGEST_XATTR).decode('ascii').split()
+    except (AttributeError, OSError, UnicodeDecodeError):
+        return None
+    if len(value) != 3 or value[1] != str(st.st_size) or \
+            value[2] != str(st.st_mtime_ns):
+        return None
+    return value[0]
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def make_etag(fs):
+    ''' Returns a strong entity tag that changes whenever the file identified
+        by the given stat result is replaced or modified.
+    '''
+    return '"{0:x}-{1:x}-{2:x}"'.format(fs.st_ino, fs.st_size, fs.st_mtime_ns)
+
+
+def etag_matches(header, etag):
+    ''' Checks whether an If-None-Match header value matches the given entity
+        tag using the weak comparison function.
+    '''
+    if header.strip() == '*':
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def is_modified_since(header, mtime):
+    ''' Checks whether a file with the given modification time has been
+        modified after the date in an If-Modified-Since header. Malformed
+        dates are treated as if the file has been modified.
+    '''
+    try:
+        ims = email.utils.parsedate_to_datetime(header)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return True
+    if ims.tzinfo is None:
+        ims = ims.replace(tzinfo=datetime.timezone.utc)
+    last_modified = datetime.datetime.fromtimestamp(mtime,
+                                                    datetime.timezone.utc)
+    return last_modified.replace(microsecond=0) > ims
+
+
+def parse_range_header(value, size):
+    ''' Parses the value of a Range header for a resource of the given size.
+        Returns a list of (start, length) tuples of the satisfiable ranges.
+        Returns None if the header is malformed and should be ignored.
+    '''
+    unit, _, range_set = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ret = []
+    for spec in range_set.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        first = first.strip()
+        last = last.strip()
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            if not last:
+                return None
+            suffix = int(last)
+            if suffix == 0 or size == 0:
+                continue
+            start = max(0, size - suffix)
+            ret.append((start, size - start))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        end = size - 1 if not last else min(int(last), size - 1)
+        ret.append((start, end - start + 1))
+    return ret
 
 
 class SimpleHTTPFileServer(SimpleHTTPRequestHandler):
@@ -38,16 +898,34 @@ class SimpleHTTPFileServer(SimpleHTTPRequestHandler):
     '''
 
     server_version = "SimpleHTTPFileServer/1.0"
+    # headers and body are separate writes, which on a persistent connection
+    # would otherwise wait for the delayed ACK of the previous response
+    disable_nagle_algorithm = True
+    response_ranges = None
+    content_encoding = None
+    request_start = None
+    # the body of a response from the file cache, sent along with the headers
+    pending_body = None
 
     def send_head(self):
         ''' The differences between standard send_head() are as follows:
             - in case path is directory, we return the listing as json data
             - we always send 'application/octet-stream' content type
+            - byte ranges are supported for files
+            - entity tags are derived from inode, size and modification time
+            - precompressed or compressed variants are selected according to
+              Accept-Encoding if enabled
         '''
         path = self.translate_path(self.path)
         f = None
+        self.response_ranges = None
+        self.content_encoding = None
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
 
-        if os.path.isdir(path):
+        if st is not None and stat.S_ISDIR(st.st_mode):
             parts = urllib.parse.urlsplit(self.path)
             if not parts.path.endswith('/'):
                 # redirect browser - doing basically what apache does
@@ -56,9 +934,33 @@ class SimpleHTTPFileServer(SimpleHTTPRequestHandler):
                              parts[3], parts[4])
                 new_url = urllib.parse.urlunsplit(new_parts)
                 self.send_header("Location", new_url)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
-            return self.list_directory(path)
+            return self.list_directory(path, st)
+
+        options = self.get_options()
+        if st is not None and (options.precompressed or options.compress):
+            accepted = parse_accept_encoding(
+                self.headers.get('Accept-Encoding'))
+            if options.precompressed:
+                path, st = self.find_precompressed(path, st, accepted)
+            if options.compress and self.content_encoding is None and \
+                    accepts_encoding(accepted, 'gzip') and \
+                    'Range' not in self.headers:
+                cached = self.get_compressed_file(path, st)
+                if cached is not None and cached.body is not None:
+                    self.content_encoding = 'gzip'
+                    self.send_cached_file(cached, accept_ranges=False)
+                    return None
+
+        file_cache = self.get_file_cache()
+        if file_cache is not None and st is not None and \
+                'Range' not in self.headers:
+            cached = file_cache.get(path, st)
+            if cached is not None:
+                self.send_cached_file(cached)
+                return None
 
         try:
             f = open(path, 'rb')
@@ -66,87 +968,939 @@ class SimpleHTTPFileServer(SimpleHTTPRequestHandler):
             self.send_error(HTTPStatus.NOT_FOUND, "File not found")
             return None
         try:
-            self.send_response(HTTPStatus.OK)
-            self.send_header("Content-type", 'application/octet-stream')
             fs = os.fstat(f.fileno())
-            self.send_header("Content-Length", str(fs[6]))
-            self.send_header("Last-Modified",
-                             self.date_time_string(fs.st_mtime))
+            size = fs.st_size
+            last_modified = self.date_time_string(fs.st_mtime)
+            etag = make_etag(fs)
+
+            if not self.is_modified(etag, fs.st_mtime):
+                f.close()
+                self.send_not_modified(etag, last_modified)
+                return None
+
+            digest = self.get_stored_digest(f, fs)
+            ranges = self.get_requested_ranges(size, etag, last_modified)
+            if ranges is None and file_cache is not None and \
+                    size <= file_cache.max_file_size:
+                cached = CachedFile(f.read(size + 1), etag, last_modified,
+                                    fs.st_mtime, digest)
+                f.close()
+                if len(cached.body) == size:
+                    file_cache.put(path, fs, cached, size)
+                self.send_cached_file(cached)
+                return None
+
+            if ranges is not None and not ranges:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", "bytes */{0}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            if ranges is None:
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-type", 'application/octet-stream')
+                self.send_header("Content-Length", str(size))
+            elif len(ranges) == 1:
+                start, length = ranges[0]
+                self.response_ranges = ([(b'', start, length)], b'')
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-type", 'application/octet-stream')
+                self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                    start, start + length - 1, size))
+                self.send_header("Content-Length", str(length))
+            else:
+                boundary = uuid.uuid4().hex
+                self.response_ranges = self._make_multipart_ranges(
+                    ranges, size, boundary)
+                parts, trailer = self.response_ranges
+                total = len(trailer) + sum(len(header) + length
+                                           for header, _, length in parts)
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-type",
+                                 'multipart/byteranges; boundary=' + boundary)
+                self.send_header("Content-Length", str(total))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_encoding_headers()
+            self.send_digest_headers(digest)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
             self.end_headers()
             return f
         except Exception:
             f.close()
             raise
 
+    def find_precompressed(self, path, st, accepted):
+        ''' Returns the path and stat result of the preferred precompressed
+            sibling of a file that the client accepts and that is not older
+            than the file itself. Sets content_encoding if one is found.
+        '''
+        if not stat.S_ISREG(st.st_mode):
+            return path, st
+        for coding, suffix in PRECOMPRESSED_SUFFIXES:
+            if not accepts_encoding(accepted, coding):
+                continue
+            try:
+                sibling_st = os.stat(path + suffix)
+            except OSError:
+                continue
+            if stat.S_ISREG(sibling_st.st_mode) and \
+                    sibling_st.st_mtime_ns >= st.st_mtime_ns:
+                self.content_encoding = coding
+                return path + suffix, sibling_st
+        return path, st
+
+    def get_compressed_file(self, path, st):
+        ''' Returns the gzipped contents of a small file as a CachedFile whose
+            body is None if the file does not compress well. Returns None if
+            the file is not compressed at all.
+        '''
+        options = self.get_options()
+        if not stat.S_ISREG(st.st_mode) or \
+                st.st_size > options.compress_max_file_size:
+            return None
+        cache = self.get_compressed_cache()
+        if cache is not None:
+            cached = cache.get(path, st)
+            if cached is not None:
+                return cached
+
+        try:
+            with open(path, 'rb') as f:
+                fs = os.fstat(f.fileno())
+                data = f.read(fs.st_size + 1)
+        except OSError:
+            return None
+        if len(data) != fs.st_size:
+            return None
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        body = compressor.compress(data) + compressor.flush()
+        if len(body) > len(data) * 0.9:
+            body = None
+        etag = make_etag(fs)
+        cached = CachedFile(body, etag[:-1] + '-gzip"',
+                            self.date_time_string(fs.st_mtime), fs.st_mtime,
+                            None)
+        if cache is not None:
+            cache.put(path, fs, cached, len(body or b'') +
+                      cache.entry_overhead)
+        return cached
+
+    def send_encoding_headers(self):
+        options = self.get_options()
+        if self.content_encoding is not None:
+            self.send_header("Content-Encoding", self.content_encoding)
+        if options.precompressed or options.compress:
+            self.send_header("Vary", "Accept-Encoding")
+
+    def get_stored_digest(self, f, st):
+        ''' Returns the hex SHA-256 digest stored for the file f or None.
+            Digests describe the unencoded file only.
+        '''
+        if not self.get_options().store_digests or \
+                self.content_encoding is not None:
+            return None
+        return load_digest(f.fileno(), st)
+
+    def send_digest_headers(self, digest):
+        if digest is None:
+            return
+        self.send_header("Digest", "sha-256=" + base64.b64encode(
+            bytes.fromhex(digest)).decode('ascii'))
+        self.send_header("X-Checksum-Sha256", digest)
+
+    def send_not_modified(self, etag, last_modified):
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+
+    def send_cached_file(self, cached, accept_ranges=True):
+        ''' Sends a whole file from memory with a single write '''
+        if not self.is_modified(cached.etag, cached.mtime):
+            self.send_not_modified(cached.etag, cached.last_modified)
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", 'application/octet-stream')
+        self.send_header("Content-Length", str(len(cached.body)))
+        if accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_encoding_headers()
+        self.send_digest_headers(cached.digest)
+        self.send_header("ETag", cached.etag)
+        self.send_header("Last-Modified", cached.last_modified)
+        if self.command != 'HEAD':
+            self.pending_body = cached.body
+        self.end_headers()
+
+    def is_modified(self, etag, mtime):
+        ''' Evaluates the If-None-Match and If-Modified-Since headers. Returns
+            False if the client already has the current version of the file.
+        '''
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return not etag_matches(if_none_match, etag)
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            return is_modified_since(if_modified_since, mtime)
+        return True
+
+    def get_requested_ranges(self, size, etag, last_modified):
+        ''' Returns the list of (start, length) tuples requested via the Range
+            header, an empty list if none of them are satisfiable or None if
+            the whole file should be sent.
+        '''
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            return None
+
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and \
+                if_range.strip() not in (etag, last_modified):
+            return None
+
+        ranges = parse_range_header(range_header, size)
+        if ranges is not None and \
+                len(ranges) > self.get_options().max_ranges:
+            return None
+        return ranges
+
+    def _make_multipart_ranges(self, ranges, size, boundary):
+        parts = []
+        for start, length in ranges:
+            header = ('\r\n--{0}\r\n'
+                      'Content-type: application/octet-stream\r\n'
+                      'Content-Range: bytes {1}-{2}/{3}\r\n'
+                      '\r\n').format(boundary, start, start + length - 1,
+                                     size)
+            parts.append((header.encode('latin-1'), start, length))
+        trailer = '\r\n--{0}--\r\n'.format(boundary).encode('latin-1')
+        return (parts, trailer)
+
+    def get_options(self):
+        if hasattr(self.server, 'options') and \
+                self.server.options is not None:
+            return self.server.options
+        return default_server_options
+
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+        if self.get_options().keep_alive:
+            self.protocol_version = "HTTP/1.1"
+        self.handled_requests = 0
+
+    def set_connection_timeout(self, timeout):
+        self.connection.settimeout(timeout)
+
+    def handle_one_request(self):
+        # The whole request is subject to the idle timeout so that idle or
+        # stalled clients do not hold a listener thread forever. It applies to
+        # each send and receive, so slow transfers that keep making progress
+        # are not cut.
+        self.set_connection_timeout(self.get_options().idle_timeout)
+        try:
+            super().handle_one_request()
+        finally:
+            self.log_access()
+
+    def parse_request(self):
+        self.handled_requests += 1
+        self.request_start = time.monotonic()
+        self.request_bytes_start = self.wfile.bytes_written
+        self.ttfb = None
+        self.response_status = None
+        self.auth_user = None
+        self.bytes_received = 0
+        return super().parse_request()
+
+    def flush_headers(self):
+        if self.request_start is not None and self.ttfb is None:
+            self.ttfb = time.monotonic() - self.request_start
+        if self.pending_body is not None:
+            self._headers_buffer.append(self.pending_body)
+            self.pending_body = None
+        super().flush_headers()
+
+    def log_request(self, code='-', size='-'):
+        if isinstance(code, int):
+            self.response_status = int(code)
+        super().log_request(code, size)
+
+    def end_headers(self):
+        if not self.close_connection:
+            if self.handled_requests >= \
+                    self.get_options().max_keep_alive_requests:
+                self.send_header("Connection", "close")
+            elif self.request_version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+        super().end_headers()
+
+    def _get_sendfile_fd(self, source, outputfile):
+        if not self.get_options().use_sendfile:
+            return None
+        if outputfile is not self.wfile:
+            return None
+        try:
+            fd = source.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return None
+        return fd
+
+    def copyfile(self, source, outputfile):
+        ''' Sends regular files via socket.sendfile() so that the data does not
+            pass through userspace buffers. Other sources, such as directory
+            listings, are copied by the standard implementation. If send_head()
+            selected byte ranges, only these are sent.
+        '''
+        if isinstance(source, StreamedBody):
+            for data in source:
+                outputfile.write(data)
+            return
+
+        if self.response_ranges is None:
+            self.copy_file_range(source, outputfile, 0, None)
+            return
+
+        parts, trailer = self.response_ranges
+        for header, start, length in parts:
+            outputfile.write(header)
+            self.copy_file_range(source, outputfile, start, length)
+        outputfile.write(trailer)
+
+    def copy_file_range(self, source, outputfile, offset, length):
+        if self._get_sendfile_fd(source, outputfile) is None:
+            if offset == 0 and length is None:
+                super().copyfile(source, outputfile)
+                return
+            source.seek(offset)
+            self.copy_fileobj_length(source, outputfile, length)
+            return
+        outputfile.flush()
+        outputfile.bytes_written += self.connection.sendfile(source, offset,
+                                                             length)
+
     def do_HEAD(self):
         self.log_headers_if_needed()
         super().do_HEAD()
 
     def do_GET(self):
         self.log_headers_if_needed()
-        super().do_GET()
+        f = self.send_head()
+        if f:
+            self.send_body(f)
+
+    def send_body(self, f):
+        try:
+            self.copyfile(f, self.wfile)
+        finally:
+            f.close()
 
     def do_PUT(self):
         self.log_headers_if_needed()
 
         path = self.translate_path(self.path)
-        if os.path.isdir(path):
+        extract = self.get_query_params().get('extract', [None])[0]
+        if extract is not None and extract != 'tar':
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                            "Unsupported archive format")
+            return
+        if extract is None and os.path.isdir(path) or \
+                extract is not None and os.path.isfile(path):
             self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
             return
+        try:
+            expected_digests = parse_expected_digests(self.headers)
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Malformed digest header")
+            return
         try:
             parent_dir = os.path.dirname(path)
-            if not os.path.exists(parent_dir):
+            if extract is None and not os.path.exists(parent_dir):
                 os.makedirs(parent_dir)
 
-            length = int(self.headers.get('Content-Length'))
-
-            fout = open(path, 'wb')
-            self.copy_fileobj_length(self.rfile, fout, length)
-            fout.close()
-
+            transfer_encoding = self.headers.get('Transfer-Encoding')
+            if transfer_encoding is not None:
+                if transfer_encoding.strip().lower() != 'chunked':
+                    self.send_error(HTTPStatus.NOT_IMPLEMENTED,
+                                    "Unsupported transfer encoding")
+                    return
+                in_file = ChunkedReader(self.rfile)
+                length = None
+            else:
+                if self.headers.get('Content-Length') is None:
+                    self.send_error(HTTPStatus.LENGTH_REQUIRED)
+                    return
+                in_file = self.rfile
+                length = int(self.headers.get('Content-Length'))
+
+            self.send_continue_if_expected()
+
+            start_time = time.monotonic()
+            if extract is not None:
+                length = self.receive_archive(path, in_file, length,
+                                              expected_digests)
+            else:
+                try:
+                    length = self.receive_file(path, in_file, length,
+                                               expected_digests)
+                finally:
+                    self.invalidate_listings(path)
+                    self.invalidate_cached_file(path)
+            self.bytes_received = length
+            self.log_transfer_rate(length, time.monotonic() - start_time)
+
+        except EOFError as e:
+            self.log_message("%s", str(e))
+            self.send_error(HTTPStatus.BAD_REQUEST, "Incomplete request body")
+            return
+        except DigestMismatchError as e:
+            self.log_message("%s", str(e))
+            self.send_error(HTTPStatus.BAD_REQUEST, "Digest mismatch")
+            return
+        except ValueError as e:
+            self.log_message("%s", str(e))
+            self.send_error(HTTPStatus.BAD_REQUEST, "Malformed request body")
+            return
+        except socket.timeout as e:
+            self.log_message("Request body timed out: %r", e)
+            self.send_error(HTTPStatus.REQUEST_TIMEOUT)
+            return
+        except PermissionError as e:
+            self.log_message("%s", str(e))
+            self.send_error(HTTPStatus.FORBIDDEN)
+            return
         except Exception as e:
             self.log_message("%s", str(e))
             self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
             return
 
         self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
-    def _get_directory_list_file_type(self, path):
-        if os.path.isfile(path):
+    def get_listing_cache(self):
+        if hasattr(self.server, 'listing_cache'):
+            return self.server.listing_cache
+        return None
+
+    def get_file_cache(self):
+        if hasattr(self.server, 'file_cache'):
+            return self.server.file_cache
+        return None
+
+    def get_compressed_cache(self):
+        if hasattr(self.server, 'compressed_cache'):
+            return self.server.compressed_cache
+        return None
+
+    def invalidate_cached_file(self, path):
+        for cache in [self.get_file_cache(), self.get_compressed_cache()]:
+            if cache is not None:
+                cache.invalidate(path)
+
+    def invalidate_listings(self, path):
+        ''' Drops the cached listings of all directories containing path '''
+        cache = self.get_listing_cache()
+        if cache is None:
+            return
+        root = os.path.normpath(getattr(self, 'directory', os.getcwd()))
+        path = os.path.dirname(os.path.normpath(path))
+        while path.startswith(root):
+            cache.invalidate(path)
+            if path == root:
+                break
+            path = os.path.dirname(path)
+
+    def handle_expect_100(self):
+        # 100 Continue is sent by do_PUT() once the request has been checked
+        return True
+
+    def send_continue_if_expected(self):
+        expect = self.headers.get('Expect')
+        if expect is None or expect.strip().lower() != '100-continue':
+            return
+        # interim responses do not exist in HTTP/1.0
+        if self.request_version < 'HTTP/1.1' or \
+                self.protocol_version < 'HTTP/1.1':
+            return
+        self.wfile.write('{0} {1} {2}\r\n\r\n'.format(
+            self.protocol_version, HTTPStatus.CONTINUE.value,
+            HTTPStatus.CONTINUE.phrase).encode('latin-1'))
+
+    def receive_file(self, path, in_file, length, expected_digests=()):
+        ''' Writes the request body read from in_file to the given path and
+            returns its length. If length is None, in_file is read until its
+            end. In atomic mode the data is written to a temporary file in the
+            same directory which then replaces the destination, so readers see
+            either the old or the new contents. The partially written file is
+            removed on failure. If the body does not match expected_digests,
+            DigestMismatchError is raised before the destination is touched.
+        '''
+        options = self.get_options()
+        hashers = make_hashers(expected_digests, options.store_digests)
+        if options.atomic_put or expected_digests:
+            write_path = make_temp_upload_path(path)
+            fd = os.open(write_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o666)
+        else:
+            write_path = path
+            fd = os.open(write_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o666)
+
+        try:
+            length = self.write_file(fd, in_file, length, hashers)
+            check_digests(hashers, expected_digests)
+            if write_path != path:
+                os.replace(write_path, path)
+        except BaseException:
+            try:
+                os.remove(write_path)
+            except FileNotFoundError:
+                # e.g. removed by a failed upload of the same path
+                pass
+            raise
+
+        if options.fsync_policy == 'file+dir':
+            fsync_directory(os.path.dirname(path))
+        return length
+
+    def write_file(self, fd, in_file, length, hashers=None):
+        ''' Writes the data read from in_file to the file descriptor fd,
+            closes it and returns the number of written bytes. The data is fed
+            to the hash objects in the hashers dict. The SHA-256 digest is
+            stored if enabled and the data is synced to disk unless the fsync
+            policy is 'none'.
+        '''
+        options = self.get_options()
+        if hashers is None:
+            hashers = make_hashers((), options.store_digests)
+        with open(fd, 'wb') as fout:
+            length = self.copy_fileobj_length(in_file, fout, length,
+                                              hashers=hashers.values())
+            fout.flush()
+            if options.store_digests:
+                store_digest(fout.fileno(), hashers['sha256'].hexdigest())
+            if options.fsync_policy != 'none':
+                os.fsync(fout.fileno())
+        return length
+
+    def get_upload_perm_walker(self, path):
+        ''' Returns a PermWalker that decides which entries below path may
+            be written or None if all of them may be written.
+        '''
+        return None
+
+    def _get_upload_walker(self, walkers, rel_path):
+        # the walkers of directories are kept, so each entry costs one step
+        rel_dir, name = os.path.split(rel_path)
+        walker = walkers.get(rel_dir)
+        if walker is None:
+            walker = self._get_upload_walker(walkers, rel_dir)
+            walkers[rel_dir] = walker
+        return walker.child(name)
+
+    def receive_archive(self, path, in_file, length, expected_digests=()):
+        ''' Extracts a tar archive, optionally compressed, read from in_file
+            into the directory path and returns the length of the request
+            body. If length is None, in_file is read until its end. The files
+            are written as an UploadBatch, so they become visible only once
+            the whole archive has been received and a failed upload leaves
+            nothing behind. Entries that are neither files nor directories
+            are skipped. Raises ValueError if an entry would be extracted
+            outside of path and PermissionError if it may not be written.
+            expected_digests are checked against the whole body.
+        '''
+        options = self.get_options()
+        hashers = make_hashers(expected_digests, False)
+        reader = LimitedReader(in_file, length, hashers.values())
+        root = os.path.normpath(path)
+        walkers = {'': self.get_upload_perm_walker(root)}
+        batch = UploadBatch()
+        try:
+            batch.make_dirs(root)
+            with tarfile.open(fileobj=reader, mode='r|*') as archive:
+                for member in archive:
+                    name = os.path.normpath(member.name)
+                    if name == '.':
+                        continue
+                    if os.path.isabs(name) or name == '..' or \
+                            name.startswith('../'):
+                        raise ValueError('Invalid archive entry name ' +
+                                         member.name)
+                    if not member.isfile() and not member.isdir():
+                        self.log_message('"%s" skipped archive entry %s',
+                                         self.path, member.name)
+                        continue
+                    if walkers[''] is not None and \
+                            not self._get_upload_walker(walkers,
+                                                        name).allowed():
+                        raise PermissionError('Not allowed to write ' +
+                                              member.name)
+
+                    target = os.path.join(root, name)
+                    if member.isdir():
+                        batch.make_dirs(target)
+                        continue
+                    batch.make_dirs(os.path.dirname(target))
+                    self.write_file(batch.open(target),
+                                    archive.extractfile(member), member.size)
+
+            # e.g. the padding after the end of the archive
+            buf = get_thread_buffer(options.upload_buffer_size)
+            while reader.readinto(buf):
+                pass
+            check_digests(hashers, expected_digests)
+            batch.commit(options.fsync_policy == 'file+dir')
+        except tarfile.TarError as e:
+            batch.rollback()
+            raise ValueError(str(e))
+        except BaseException:
+            batch.rollback()
+            raise
+        finally:
+            for target in batch.paths() + batch.created_dirs:
+                self.invalidate_listings(target)
+                self.invalidate_cached_file(target)
+        return reader.count
+
+    def _get_directory_list_file_type(self, entry):
+        # The type is usually known from the directory listing itself, thus
+        # stat() is called only for symlinks and on some file systems
+        if entry.is_file():
             return 'file'
-        if os.path.isdir(path):
+        if entry.is_dir():
             return 'directory'
         return 'other'
 
-    def list_directory(self, path):
+    def get_listing_perm_walker(self, path):
+        ''' Returns a PermWalker that decides which subdirectories of path may
+            be listed or None if all of them may be listed.
+        '''
+        return None
+
+    def _stat_entry(self, entry):
         try:
-            contents = os.listdir(path)
+            return entry.stat()
         except OSError:
-            self.send_error(HTTPStatus.NOT_FOUND, "Could not list directory")
             return None
 
-        ret = {fn: self._get_directory_list_file_type(os.path.join(path, fn))
-               for fn in contents}
+    def _walk_directory(self, path, walker, max_depth, should_sort,
+                        should_stat):
+        ''' Yields (relative path, type, stat result, walker) tuples for the
+            entries below path down to max_depth levels. Subdirectories that
+            may not be listed and symlinks to directories are not descended
+            into. The stat result is None unless should_stat is set. The
+            walker is the PermWalker of the entry or None if walker is None.
+        '''
+        stack = [('', walker, 1)]
+        while stack:
+            rel_dir, walker, depth = stack.pop()
+            try:
+                with os.scandir(os.path.join(path, rel_dir)) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            if should_sort:
+                entries.sort(key=lambda e: e.name)
+
+            subdirs = []
+            for entry in entries:
+                rel_path = rel_dir + '/' + entry.name if rel_dir \
+                    else entry.name
+                file_type = self._get_directory_list_file_type(entry)
+                st = self._stat_entry(entry) if should_stat else None
+                child = walker.child(entry.name) if walker is not None \
+                    else None
+                yield (rel_path, file_type, st, child)
+
+                if file_type != 'directory' or entry.is_symlink():
+                    continue
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                if child is None or child.allowed():
+                    subdirs.append((rel_path, child, depth + 1))
+            stack.extend(reversed(subdirs))
+
+    def list_directory_recursive(self, path, query):
+        ''' Returns the listing of all entries below path as a StreamedBody
+            with one JSON array per line. The arrays contain the path relative
+            to the listed directory and the type of the entry. The following
+            query parameters are supported:
+             - depth=N: at most N levels of subdirectories are listed
+             - details=1: the size, mtime_ns and inode of entries are
+               appended
+             - sort=0: entries of each directory are not sorted
+        '''
+        try:
+            max_depth = query.get('depth')
+            max_depth = int(max_depth[0]) if max_depth is not None else None
+            if max_depth is not None and max_depth < 1:
+                raise ValueError()
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Invalid depth")
+            return None
+        should_stat = query.get('details', ['0'])[0] == '1'
+        should_sort = query.get('sort', ['1'])[0] != '0'
+
+        walker = self.get_listing_perm_walker(path)
+        rows = self._walk_directory(path, walker, max_depth, should_sort,
+                                    should_stat)
+        if should_stat:
+            rows = (self._make_details_row(rel_path, file_type, st)
+                    for rel_path, file_type, st, child in rows)
+        else:
+            rows = ([rel_path, file_type]
+                    for rel_path, file_type, st, child in rows)
+
+        body = StreamedBody(encode_ndjson(rows))
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "application/x-ndjson")
+        self.send_streamed_body_headers(body, self.should_compress_listing())
+        self.end_headers()
+        return body
+
+    def send_archive(self, path, archive_format):
+        ''' Returns an archive of all entries below path as a StreamedBody.
+            The archive is produced while the tree is walked, so it is never
+            stored. archive_format is one of the keys of ARCHIVE_FORMATS.
+            Subdirectories that may not be listed are archived as empty
+            directories and files that may not be read are left out.
+        '''
+        if archive_format not in ARCHIVE_FORMATS:
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                            "Unsupported archive format")
+            return None
+        content_type, encode = ARCHIVE_FORMATS[archive_format]
+
+        walker = self.get_listing_perm_walker(path)
+        read_bit = PERM_BITS['r']
+        entries = self._walk_directory(path, walker, None, True, False)
+        entries = ((rel_path, file_type, os.path.join(path, rel_path))
+                   for rel_path, file_type, st, child in entries
+                   if file_type == 'directory' or (
+                       file_type == 'file' and (
+                           child is None or child.allows(read_bit))))
+
+        name = os.path.basename(os.path.normpath(path)) or 'archive'
+        body = StreamedBody(encode(entries))
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Disposition",
+                         "attachment; filename*=UTF-8''{0}.{1}".format(
+                             urllib.parse.quote(name), archive_format))
+        self.send_streamed_body_headers(body)
+        self.end_headers()
+        return body
+
+    def _scan_directory(self, it, should_stat=False):
+        with it:
+            for entry in it:
+                if should_stat:
+                    yield (entry.name,
+                           self._get_directory_list_file_type(entry),
+                           self._stat_entry(entry))
+                else:
+                    yield (entry.name,
+                           self._get_directory_list_file_type(entry))
+
+    def _make_details_row(self, name, file_type, st):
+        if st is None:
+            return [name, file_type, None, None, None]
+        return [name, file_type, st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get_query_params(self):
+        query = urllib.parse.urlsplit(self.path).query
+        return urllib.parse.parse_qs(query, keep_blank_values=True)
+
+    def list_directory(self, path, st=None):
+        ''' Returns the listing of the directory as a StreamedBody. st is the
+            result of os.stat(path) if the caller already has it. The
+            following query parameters are supported:
+             - sort=0: entries are sent in the order the file system returns
+               them, as soon as they are read
+             - limit=N: at most N entries are returned. If more are available,
+               the X-Next-After header holds the last returned name.
+             - after=NAME: only entries whose names sort after NAME are
+               returned
+             - details=1: instead of a JSON object, one JSON array per line is
+               returned holding the name, type, size, mtime_ns and inode of
+               each entry
+             - recursive=1: the whole subtree is listed, see
+               list_directory_recursive()
+             - archive=FORMAT: the whole subtree is sent as an archive, see
+               send_archive()
+        '''
+        query = self.get_query_params()
+        if query.get('recursive', ['0'])[0] == '1':
+            return self.list_directory_recursive(path, query)
+        if 'archive' in query:
+            return self.send_archive(path, query['archive'][0])
+
+        try:
+            limit = query.get('limit')
+            limit = int(limit[0]) if limit is not None else None
+            if limit is not None and limit < 1:
+                raise ValueError()
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Invalid limit")
+            return None
+        after = query.get('after', [None])[0]
+        should_sort = query.get('sort', ['1'])[0] != '0'
+        should_stat = query.get('details', ['0'])[0] == '1'
+
+        cache = self.get_listing_cache()
+        if cache is None or query:
+            st = None
+        elif st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.send_error(HTTPStatus.NOT_FOUND,
+                                "Could not list directory")
+                return None
+        if st is not None:
+            cached = cache.get(path, st)
+            if cached is not None:
+                body = StreamedBody([cached])
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-type", "text/json; charset=utf-8")
+                if self.should_compress_listing():
+                    self.send_streamed_body_headers(body, compress=True)
+                else:
+                    self.send_header("Content-Length", str(len(cached)))
+                self.end_headers()
+                return body
+
+        try:
+            it = os.scandir(path)
+            entries = self._scan_directory(it, should_stat)
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "Could not list directory")
+            return None
 
-        encoded = json.dumps(ret, sort_keys=True).encode('utf-8')
+        next_after = None
+        try:
+            if after is not None:
+                entries = (e for e in entries if e[0] > after)
+            if limit is not None:
+                # only the requested page is kept in memory
+                entries = heapq.nsmallest(limit + 1, entries)
+                if len(entries) > limit:
+                    entries = entries[:limit]
+                    next_after = entries[-1][0] if entries else after
+            elif should_sort:
+                entries = sorted(entries)
+        except OSError:
+            it.close()
+            self.send_error(HTTPStatus.NOT_FOUND, "Could not list directory")
+            return None
 
-        f = io.BytesIO()
-        f.write(encoded)
-        f.seek(0)
+        if should_stat:
+            chunks = encode_ndjson(self._make_details_row(*entry)
+                                   for entry in entries)
+            content_type = "application/x-ndjson"
+        else:
+            chunks = encode_listing(entries)
+            content_type = "text/json; charset=utf-8"
+        if st is not None:
+            chunks = cache.record(path, st, chunks)
+        body = StreamedBody(chunks, it.close)
         self.send_response(HTTPStatus.OK)
-        self.send_header("Content-type", "text/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(encoded)))
+        self.send_header("Content-type", content_type)
+        if next_after is not None:
+            self.send_header("X-Next-After", urllib.parse.quote(next_after))
+        self.send_streamed_body_headers(body, self.should_compress_listing())
         self.end_headers()
-        return f
+        return body
 
-    def copy_fileobj_length(self, in_file, out_file, length, bufsize=1024*128):
-        while length > 0:
-            if length < bufsize:
-                bufsize = length
-            length -= bufsize
+    def should_compress_listing(self):
+        return accepts_encoding(parse_accept_encoding(
+            self.headers.get('Accept-Encoding')), 'gzip')
 
-            out_file.write(in_file.read(bufsize))
+    def send_streamed_body_headers(self, body, compress=False):
+        ''' Sends the headers that delimit a StreamedBody. The chunked coding
+            is used when the connection stays open, otherwise the body ends
+            when the connection is closed. If compress is set, the body is
+            gzipped while it is being sent.
+        '''
+        if compress:
+            body.chunks = gzip_chunks(body.chunks)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        if not self.close_connection and self.request_version >= 'HTTP/1.1':
+            body.chunked = True
+            self.send_header("Transfer-Encoding", "chunked")
+        elif not self.close_connection:
+            self.send_header("Connection", "close")
+
+    def copy_fileobj_length(self, in_file, out_file, length, bufsize=None,
+                            hashers=()):
+        ''' Copies exactly length bytes from in_file to out_file through a
+            reused per-thread buffer and returns the number of copied bytes.
+            The data is also fed to the given hash objects. Raises EOFError if
+            in_file ends early. If length is None, copies until the end of
+            in_file.
+        '''
+        if bufsize is None:
+            bufsize = self.get_options().upload_buffer_size
+        if length is None:
+            buf = get_thread_buffer(bufsize)
+            copied = 0
+            while True:
+                read = in_file.readinto(buf)
+                if not read:
+                    return copied
+                out_file.write(buf[:read])
+                for hasher in hashers:
+                    hasher.update(buf[:read])
+                copied += read
+
+        buf = get_thread_buffer(min(bufsize, length))
+        remaining = length
+        while remaining > 0:
+            view = buf[:min(remaining, len(buf))]
+            read = in_file.readinto(view)
+            if not read:
+                raise EOFError('Expected {0} bytes, got only {1}'.format(
+                    length, length - remaining))
+            out_file.write(view[:read])
+            for hasher in hashers:
+                hasher.update(view[:read])
+            remaining -= read
+        return length
+
+    def log_transfer_rate(self, length, elapsed):
+        rate = length / elapsed if elapsed > 0 else 0
+        self.log_message('"%s" received %d bytes in %.3f s (%.0f bytes/s)',
+                         self.path, length, elapsed, rate)
+
+    def get_access_log(self):
+        if hasattr(self.server, 'access_log'):
+            return self.server.access_log
+        return None
+
+    def log_access(self):
+        ''' Queues the access log record of the request that has just been
+            served. The record is formatted by the log writer thread.
+        '''
+        start = self.request_start
+        if start is None:
+            return
+        self.request_start = None
+        access_log = self.get_access_log()
+        if access_log is None:
+            return
+        access_log.write((time.time(), self.client_address[0], self.command,
+                          getattr(self, 'path', None), self.response_status,
+                          self.auth_user, self.bytes_received,
+                          self.wfile.bytes_written - self.request_bytes_start,
+                          self.ttfb, time.monotonic() - start))
 
     def log_write(self, msg):
         if hasattr(self.server, 'log_file') and \
@@ -181,6 +1935,109 @@ def decode_http_auth_password(txt):
     return (items[0], items[1])
 
 
+def hash_password(psw, method='scrypt'):
+    ''' Returns a salted hash of psw that can be used as the "psw_hash" value
+        of a user in the access configuration.
+    '''
+    salt = os.urandom(16)
+    if method == 'scrypt':
+        params = [2 ** 14, 8, 1]
+    elif method == 'pbkdf2_sha256':
+        params = [200000]
+    else:
+        raise ValueError('Unsupported password hash method ' + method)
+    digest = PasswordHash.compute(method, params, salt, psw)
+    return '$'.join([method] + [str(p) for p in params] +
+                    [base64.b64encode(salt).decode('ascii'),
+                     base64.b64encode(digest).decode('ascii')])
+
+
+class PasswordHash:
+
+    ''' A salted password hash in the form of either
+        scrypt$<n>$<r>$<p>$<salt>$<digest> or
+        pbkdf2_sha256$<iterations>$<salt>$<digest> where salt and digest are
+        base64-encoded.
+    '''
+
+    param_counts = {'scrypt': 3, 'pbkdf2_sha256': 1}
+
+    def __init__(self, text):
+        items = text.split('$')
+        self.method = items[0]
+        if self.method not in self.param_counts or \
+                len(items) != self.param_counts[self.method] + 3:
+            raise ValueError('Unsupported password hash format')
+        self.params = [int(p) for p in items[1:-2]]
+        self.salt = base64.b64decode(items[-2], validate=True)
+        self.digest = base64.b64decode(items[-1], validate=True)
+
+    @staticmethod
+    def compute(method, params, salt, psw):
+        psw = psw.encode('UTF-8')
+        if method == 'scrypt':
+            n, r, p = params
+            return hashlib.scrypt(psw, salt=salt, n=n, r=r, p=p,
+                                  maxmem=256 * r * n + 1024 * 1024, dklen=32)
+        return hashlib.pbkdf2_hmac('sha256', psw, salt, params[0])
+
+    def verify(self, psw):
+        digest = self.compute(self.method, self.params, self.salt, psw)
+        return hmac.compare_digest(digest, self.digest)
+
+
+class CredentialCache:
+
+    ''' Remembers recently verified Authorization header values so that the
+        password hash is computed once per client and not on every request.
+        Only digests of the header values are kept in memory.
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _key(self, auth_header):
+        return hashlib.sha256(auth_header.encode('UTF-8')).digest()
+
+    def get(self, auth_header):
+        key = self._key(auth_header)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user
+
+    def put(self, auth_header, user):
+        if self.max_size <= 0:
+            return
+        key = self._key(auth_header)
+        with self.lock:
+            self.entries[key] = (user, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+PERM_BITS = {'r': 1, 'w': 2, 'l': 4}
+ALL_PERMS = 7
+
+
+def perms_to_mask(perms):
+    mask = 0
+    for c in perms:
+        mask |= PERM_BITS.get(c, 0)
+    return mask
+
+
 class PathConfig:
     def __init__(self, filename):
         if '/' in filename:
@@ -188,16 +2045,32 @@ class PathConfig:
         self.filename = filename
         self.perms = {}
         self.children = {}
+        # user -> bitmask of the permissions in effect at this path, including
+        # the ones inherited from the parents. Filled in by AuthConfig.compile()
+        self.effective_perms = {}
 
 
 class AuthConfig:
 
+    # The number of (user, path, perm) decisions to remember
+    decision_cache_size = 4096
+    # The number of verified Authorization headers to remember and for how
+    # many seconds
+    credential_cache_size = 1024
+    credential_cache_ttl = 60
+
     def __init__(self, log_file=sys.stdout):
         self.root = PathConfig('')
         self.users = {}
         self.log_file = log_file
+        self.compiled = False
+        self.check_cached = None
+        self.credential_cache = CredentialCache(self.credential_cache_size,
+                                                self.credential_cache_ttl)
 
     def add_path_config(self, path, user, perms):
+        self.compiled = False
+
         path_items = [p for p in path.split('/')
                       if p not in ['', '.', '..']]
 
@@ -210,62 +2083,252 @@ class AuthConfig:
         p.perms[user] = perms
 
     def load_config(self, config_file_path):
+        ''' Loads the configuration from the given file. Raises an exception
+            if the file can not be read or is malformed.
+        '''
+        with open(config_file_path, 'r') as config_file:
+            config = json.load(config_file)
+
+        config_paths = config['paths']
+        for config_path in config_paths:
+            path = config_path['path']
+            user = config_path['user']
+            perms = config_path['perms']
+            self.add_path_config(path, user, perms)
+
+        config_users = config['users']
+        for config_user in config_users:
+            user = config_user['user']
+            if 'psw_hash' in config_user:
+                self.users[user] = PasswordHash(config_user['psw_hash'])
+            else:
+                self.users[user] = config_user['psw']
+
+        self.compile()
+
+    def _collect_users(self, node, users):
+        users.update(node.perms)
+        for child in node.children.values():
+            self._collect_users(child, users)
+
+    def _compile_node(self, node, parent_masks):
+        masks = {}
+        for user in parent_masks:
+            if user in node.perms:
+                masks[user] = perms_to_mask(node.perms[user])
+            elif '*' in node.perms:
+                masks[user] = perms_to_mask(node.perms['*'])
+            else:
+                masks[user] = parent_masks[user]
+        node.effective_perms = masks
+        for child in node.children.values():
+            self._compile_node(child, masks)
+
+    def compile(self):
+        ''' Precomputes the effective permissions of each user at each path of
+            the configuration. Users that are not mentioned in any path have
+            the same permissions as the user "*".
+        '''
+        users = {'*'}
+        self._collect_users(self.root, users)
+        self._compile_node(self.root, {user: ALL_PERMS for user in users})
+        self.check_cached = functools.lru_cache(
+            maxsize=self.decision_cache_size)(self._check_compiled)
+        self.compiled = True
+
+    def get_effective_perms(self, node, user):
+        masks = node.effective_perms
+        return masks.get(user, masks['*'])
+
+    def _check_compiled(self, path, perm, user):
+        node = self.root
+        for i in path.split('/'):
+            child = node.children.get(i)
+            if child is None:
+                break
+            node = child
+        return bool(self.get_effective_perms(node, user) &
+                    PERM_BITS.get(perm, 0))
+
+    def get_effective_user(self, user, psw):
+        ''' Returns the user whose permissions apply or None if the password
+            does not match.
+        '''
+        if user not in self.users:
+            return '*'
+        stored = self.users[user]
+        if isinstance(stored, PasswordHash):
+            matches = stored.verify(psw)
+        else:
+            matches = hmac.compare_digest(stored.encode('UTF-8'),
+                                          psw.encode('UTF-8'))
+        if not matches:
+            return None
+        return user
+
+    def authenticate(self, auth_header):
+        ''' Returns the user whose permissions apply to a request with the
+            given Authorization header value or None if the credentials are
+            invalid.
+        '''
+        if auth_header is None:
+            return '*'
+        user = self.credential_cache.get(auth_header)
+        if user is not None:
+            return user
+
+        if not auth_header.startswith('Basic '):
+            return None
         try:
-            config = json.load(open(config_file_path, 'r'))
-            config_paths = config['paths']
-            for config_path in config_paths:
-                path = config_path['path']
-                user = config_path['user']
-                perms = config_path['perms']
-                self.add_path_config(path, user, perms)
-
-            config_users = config['users']
-            for config_user in config_users:
-                user = config_user['user']
-                psw = config_user['psw']
-                self.users[user] = psw
+            credentials = decode_http_auth_password(auth_header[6:].strip())
+        except ValueError:
+            return None
+        if credentials is None:
+            return None
 
-        except Exception as e:
-            self.log_write("Error reading config file " + config_file_path)
-            self.log_write(str(e))
+        user = self.get_effective_user(*credentials)
+        if user is not None and user != '*':
+            self.credential_cache.put(auth_header, user)
+        return user
 
-    def check_perm(self, perms, user, perm):
-        if user in perms:
-            if perm in perms[user]:
-                return True
-            return False
+    def get_perm_walker(self, path, perm, user):
+        ''' Returns a PermWalker positioned at path for an authenticated user.
+        '''
+        if not self.compiled:
+            self.compile()
 
-        if '*' in perms:
-            if perm in perms['*']:
-                return True
-            return False
-        return None
+        walker = PermWalker(self, user, PERM_BITS.get(perm, 0), self.root)
+        for i in path.split('/'):
+            if i not in ['', '.']:
+                walker = walker.child(i)
+        return walker
 
-    def combine_perm(self, prev, next):
-        if next is None:
-            return prev
-        return next
+    def check_user_perm(self, path, perm, user):
+        if not self.compiled:
+            self.compile()
+        return self.check_cached(path, perm, user)
 
     def check_path_for_perm(self, path, perm, user, psw):
-        if user not in self.users:
-            user = '*'
-        elif self.users[user] != psw:
+        user = self.get_effective_user(user, psw)
+        if user is None:
             return False
+        return self.check_user_perm(path, perm, user)
 
-        p = self.root
-        items = path.split('/')
 
-        result = self.combine_perm(True, self.check_perm(p.perms, user, perm))
+class AccessConfig:
 
-        for i in items:
-            if i not in p.children:
-                return result
-            p = p.children[i]
+    ''' Holds the AuthConfig in effect and replaces it with a new one when
+        the access configuration file is reloaded. The new configuration is
+        fully built before it is published, so requests see either the old or
+        the new one. If the file can not be loaded, the old configuration is
+        kept.
+    '''
+
+    def __init__(self, path, log_file):
+        self.path = path
+        self.log_file = log_file
+        self.auth_config = None
+        self.file_key = None
+        self.lock = threading.Lock()
 
-            result = self.combine_perm(result,
-                                       self.check_perm(p.perms, user, perm))
+    def get_file_key(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
 
-        return result
+    def load(self):
+        ''' Loads the configuration file and returns whether it succeeded.
+        '''
+        with self.lock:
+            file_key = self.get_file_key()
+            try:
+                auth_config = AuthConfig()
+                auth_config.load_config(self.path)
+            except Exception as e:
+                self.log_file.write('Error reading access config {0}: {1}\n'
+                                    .format(self.path, e))
+                if self.auth_config is not None:
+                    self.log_file.write('Keeping the previous access '
+                                        'config\n')
+                # don't retry the same broken file on each poll
+                self.file_key = file_key
+                return False
+            self.auth_config = auth_config
+            self.file_key = file_key
+            return True
+
+    def reload(self):
+        if self.load():
+            self.log_file.write('Reloaded access config {0}\n'.format(
+                self.path))
+
+    def reload_if_changed(self):
+        if self.get_file_key() != self.file_key:
+            self.reload()
+
+
+class AccessConfigReloadThread(threading.Thread):
+
+    ''' Reloads the access configuration when requested from the SIGHUP
+        handler or, if poll_interval is not None, when the file changes.
+    '''
+
+    def __init__(self, access_config, poll_interval):
+        super().__init__()
+        self.access_config = access_config
+        self.poll_interval = poll_interval
+        self.reload_requested = threading.Event()
+
+    def request_reload(self, signum=None, frame=None):
+        self.reload_requested.set()
+
+    def run(self):
+        while True:
+            if self.reload_requested.wait(self.poll_interval):
+                self.reload_requested.clear()
+                self.access_config.reload()
+            else:
+                self.access_config.reload_if_changed()
+
+
+def start_access_config_reload_thread(access_config, options):
+    thread = AccessConfigReloadThread(access_config,
+                                      options.access_config_poll_interval)
+    thread.setDaemon(True)
+    thread.start()
+    signal.signal(signal.SIGHUP, thread.request_reload)
+
+
+class PermWalker:
+
+    ''' Evaluates a permission of a user while descending a directory tree.
+        Each step looks up a single node of the permission trie instead of
+        walking it from the root.
+    '''
+
+    def __init__(self, auth_config, user, perm_bit, node, is_exact=True):
+        self.auth_config = auth_config
+        self.user = user
+        self.perm_bit = perm_bit
+        self.node = node
+        self.is_exact = is_exact
+
+    def child(self, name):
+        node = self.node.children.get(name) if self.is_exact else None
+        if node is None:
+            # paths below the last configured one inherit its permissions
+            return PermWalker(self.auth_config, self.user, self.perm_bit,
+                              self.node, False)
+        return PermWalker(self.auth_config, self.user, self.perm_bit, node)
+
+    def allowed(self):
+        return self.allows(self.perm_bit)
+
+    def allows(self, perm_bit):
+        return bool(self.auth_config.get_effective_perms(self.node, self.user)
+                    & perm_bit)
 
 
 class AuthSimpleHTTPFileServer(SimpleHTTPFileServer):
@@ -273,21 +2336,23 @@ class AuthSimpleHTTPFileServer(SimpleHTTPFileServer):
     def do_AUTHHEAD(self):
         self.log_headers_if_needed()
 
+        body = b'Not authenticated\n'
         self.send_response(HTTPStatus.UNAUTHORIZED)
         self.send_header('WWW-Authenticate', 'Basic realm=\"Test\"')
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        if self.command not in ('GET', 'HEAD'):
+            # the request body has not been read
+            self.send_header('Connection', 'close')
         self.end_headers()
-        self.wfile.write(b'Not authenticated\n')
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
-    def _get_auth_user_and_psw_from_header(self):
-        auth_header = self.headers.get('Authorization')
-        if auth_header is None:
-            return ('*', None)
-
-        if not auth_header.startswith('Basic '):
-            return None
+    def get_auth_config(self):
+        return self.server.access_config.auth_config
 
-        return decode_http_auth_password(auth_header[6:].strip())
+    def get_auth_user(self, auth_config):
+        return auth_config.authenticate(self.headers.get('Authorization'))
 
     def check_auth_impl(self, perm):
         try:
@@ -296,23 +2361,36 @@ class AuthSimpleHTTPFileServer(SimpleHTTPFileServer):
             if path.startswith('..'):
                 return False
 
-            if os.path.isdir(path):
+            if perm == 'r' and os.path.isdir(path):
                 perm = 'l'
 
-            auth_result = self._get_auth_user_and_psw_from_header()
-            if auth_result is None:
+            # use a single configuration even if it's reloaded meanwhile
+            auth_config = self.get_auth_config()
+            user = self.get_auth_user(auth_config)
+            self.auth_user = user
+            if user is None:
                 return False
 
-            user, psw = auth_result
-
-            return self.server.auth_config.check_path_for_perm(path, perm,
-                                                               user, psw)
+            return auth_config.check_user_perm(path, perm, user)
 
         except Exception as e:
             self.log_message("%s", str(e))
-            self.wfile.write(str(e))
             return False
 
+    def get_listing_perm_walker(self, path):
+        auth_config = self.get_auth_config()
+        user = self.get_auth_user(auth_config)
+        if user is None:
+            raise Exception('Authentication failed')
+        return auth_config.get_perm_walker(os.path.relpath(path), 'l', user)
+
+    def get_upload_perm_walker(self, path):
+        auth_config = self.get_auth_config()
+        user = self.get_auth_user(auth_config)
+        if user is None:
+            raise Exception('Authentication failed')
+        return auth_config.get_perm_walker(os.path.relpath(path), 'w', user)
+
     def check_auth(self, perm):
         if not self.check_auth_impl(perm):
             self.do_AUTHHEAD()
@@ -332,45 +2410,615 @@ class AuthSimpleHTTPFileServer(SimpleHTTPFileServer):
             super().do_PUT()
 
 
-class PrintThread(threading.Thread):
-    def __init__(self, log_file, should_flush=False):
-        super().__init__()
-        self.log_file = log_file
-        self.should_flush = should_flush
-        self.queue = queue.Queue()
+class AsyncStreamWriterFile:
 
-    def run(self):
+    ''' A write-only file object that forwards data to an asyncio stream. It
+        may be used from any thread.
+    '''
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+
+    def write(self, data):
+        data = bytes(data)
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class AsyncStreamReaderFile:
+
+    ''' A read-only file object that reads data from an asyncio stream. It
+        must be used from a thread other than the one running the event loop.
+        Like a socket with a timeout, a read that receives no data within
+        timeout seconds raises socket.timeout.
+    '''
+
+    def __init__(self, loop, reader, timeout=None):
+        self.loop = loop
+        self.reader = reader
+        self.timeout = timeout
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _wait(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out') from None
+
+    async def _read(self, size):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                data = await self._wait(self.reader.read(1024 * 64))
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            # the timeout applies to each chunk, so slow transfers that keep
+            # making progress are not cut
+            data = await self._wait(self.reader.read(remaining))
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        return b''.join(chunks)
+
+    def read(self, size=-1):
+        return self._run(self._read(size))
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        line = self._run(self._wait(self.reader.readline()))
+        if size is not None and 0 <= size < len(line):
+            raise ValueError('Line too long')
+        return line
+
+
+class AsyncRequestMixin:
+
+    ''' Adapts a request handler class to the asyncio engine. A single
+        instance serves all requests of a connection. The do_* methods run in
+        an executor thread and talk to the client through file objects that
+        forward to the event loop. Bodies of GET responses are not copied by
+        the handler; they are streamed by the event loop instead.
+    '''
+
+    def __init__(self, server, client_address, loop, reader, writer):
+        # BaseRequestHandler.__init__() would handle the connection itself
+        self.server = server
+        self.client_address = client_address
+        self.request = None
+        self.connection = None
+        self.directory = os.getcwd()
+        self.loop = loop
+        self.reader = reader
+        self.wfile = CountingWriter(AsyncStreamWriterFile(loop, writer))
+        self.rfile = None
+        self.deferred_body = None
+        self.handled_requests = 0
+        if self.get_options().keep_alive:
+            self.protocol_version = "HTTP/1.1"
+
+    def set_connection_timeout(self, timeout):
+        pass
+
+    def prepare_request(self, head):
+        ''' Parses the request line and headers. Returns the handler method to
+            call or None if the request has already been answered.
+        '''
+        self.close_connection = True
+        self.raw_requestline, _, header_lines = head.partition(b'\r\n')
+        self.raw_requestline += b'\r\n'
+        self.rfile = io.BytesIO(header_lines)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(HTTPStatus.REQUEST_URI_TOO_LONG)
+            return None
+        if not self.parse_request():
+            return None
+        self.rfile = AsyncStreamReaderFile(self.loop, self.reader,
+                                           self.get_options().idle_timeout)
+
+        mname = 'do_' + self.command
+        if not hasattr(self, mname):
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED,
+                            "Unsupported method (%r)" % self.command)
+            return None
+        return getattr(self, mname)
+
+    def send_body(self, f):
+        self.deferred_body = f
+
+
+class AsyncSimpleHTTPFileServer(AsyncRequestMixin, SimpleHTTPFileServer):
+    pass
+
+
+class AsyncAuthSimpleHTTPFileServer(AsyncRequestMixin,
+                                    AuthSimpleHTTPFileServer):
+    pass
+
+
+class AsyncHTTPFileServer:
+
+    ''' Serves requests from a single event loop. File system operations are
+        handled in a pool of executor threads and uploads in a separate one,
+        whereas response bodies are streamed by the event loop, so slow
+        downloads do not occupy any thread. Reading a request body is subject
+        to the idle timeout, so stalled uploads release their thread.
+    '''
+
+    def __init__(self, socket, log_file, log_headers, access_config,
+                 num_threads, options=None, listing_cache=None,
+                 access_log=None, file_cache=None, compressed_cache=None):
+        self.socket = socket
+        self.log_file = log_file
+        self.access_log = access_log
+        self.file_cache = file_cache
+        self.compressed_cache = compressed_cache
+        self.log_headers = log_headers
+        self.access_config = access_config
+        self.options = options
+        self.num_threads = num_threads
+        self.listing_cache = listing_cache
+        self.upload_executor = None
+        if access_config is None:
+            self.RequestHandlerClass = AsyncSimpleHTTPFileServer
+        else:
+            self.RequestHandlerClass = AsyncAuthSimpleHTTPFileServer
+
+    def get_options(self):
+        if self.options is not None:
+            return self.options
+        return default_server_options
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.num_threads))
+        self.upload_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.num_threads)
+        server = await asyncio.start_server(self.handle_connection,
+                                            sock=self.socket)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        # asyncio disables Nagle's algorithm only for sockets created with
+        # IPPROTO_TCP, which the listening socket is not
+        writer.get_extra_info('socket').setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handler = self.RequestHandlerClass(self, client_address, loop,
+                                           reader, writer)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        self.get_options().idle_timeout)
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+
+                method = handler.prepare_request(head)
+                if method is not None:
+                    # uploads waiting for slow clients must not hold up the
+                    # file system operations of other requests
+                    executor = None
+                    if handler.command == 'PUT':
+                        executor = self.upload_executor
+                    await loop.run_in_executor(executor, method)
+                if handler.deferred_body is not None:
+                    await self.send_deferred_body(handler, writer)
+                await writer.drain()
+                handler.log_access()
+                if handler.close_connection:
+                    break
+        except ConnectionError:
+            pass
+        except Exception as e:
+            handler.log_message("%s", str(e))
+        finally:
+            handler.log_access()
+            if handler.deferred_body is not None:
+                handler.deferred_body.close()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def send_deferred_body(self, handler, writer):
+        source = handler.deferred_body
+        counter = handler.wfile
+        try:
+            if isinstance(source, StreamedBody):
+                await self.send_streamed_body(writer, source, counter)
+                return
+
+            if handler.response_ranges is None:
+                await self.send_file_range(writer, source, 0, None, counter)
+                return
+
+            parts, trailer = handler.response_ranges
+            for header, start, length in parts:
+                writer.write(header)
+                counter.bytes_written += len(header)
+                await self.send_file_range(writer, source, start, length,
+                                           counter)
+            writer.write(trailer)
+            counter.bytes_written += len(trailer)
+        finally:
+            handler.deferred_body = None
+            source.close()
+
+    async def send_streamed_body(self, writer, body, counter):
+        # producing the data may access the file system
+        loop = asyncio.get_running_loop()
+        it = iter(body)
         while True:
-            self.log_file.write(self.queue.get())
-            if self.should_flush:
-                self.log_file.flush()
-            self.queue.task_done()
+            data = await loop.run_in_executor(None, next, it, None)
+            if data is None:
+                break
+            writer.write(data)
+            counter.bytes_written += len(data)
+            await writer.drain()
+
+    async def send_file_range(self, writer, source, offset, length, counter):
+        loop = asyncio.get_running_loop()
+        if self.get_options().use_sendfile:
+            await writer.drain()
+            counter.bytes_written += await loop.sendfile(
+                writer.transport, source, offset, length)
+            return
+
+        source.seek(offset)
+        bufsize = 1024 * 128
+        while length is None or length > 0:
+            if length is not None and length < bufsize:
+                bufsize = length
+            data = await loop.run_in_executor(None, source.read, bufsize)
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            writer.write(data)
+            counter.bytes_written += len(data)
+            await writer.drain()
+
+
+class LogFile:
+
+    ''' A log file that is written by a log writer thread. It is reopened
+        before the next write once reopen is requested, e.g. after the file
+        has been moved away by an external tool. It is rotated once it grows
+        beyond max_size bytes or is older than rotate_interval seconds. The
+        rotated segments are named <path>.<timestamp>, optionally gzipped in
+        a background thread, and only the newest backup_count ones are kept.
+    '''
 
+    def __init__(self, path, buffer_size, max_size=None, rotate_interval=None,
+                 backup_count=5, compress=False):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.reopen_requested = False
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'a', buffering=self.buffer_size)
+        self.size = self.file.tell()
+        self.opened = time.monotonic()
+
+    def request_reopen(self):
+        # called from signal handlers, thus just sets a flag
+        self.reopen_requested = True
+
+    def should_rotate(self):
+        if self.size == 0:
+            return False
+        if self.max_size is not None and self.size >= self.max_size:
+            return True
+        return self.rotate_interval is not None and \
+            time.monotonic() - self.opened >= self.rotate_interval
 
-class FileQueueWrapper:
-    def __init__(self, queue):
-        self.queue = queue
+    def write(self, data):
+        if self.reopen_requested or self.file.closed:
+            # the file is closed if reopening or rotating it has failed
+            self.reopen_requested = False
+            self.file.close()
+            self.open()
+        elif self.should_rotate():
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        rotated_path = self.path + '.' + time.strftime('%Y%m%d-%H%M%S')
+        i = 0
+        candidate = rotated_path
+        while os.path.exists(candidate) or \
+                os.path.exists(candidate + '.gz'):
+            i += 1
+            candidate = '{0}-{1}'.format(rotated_path, i)
+        try:
+            os.rename(self.path, candidate)
+        except FileNotFoundError:
+            # the log has been moved away without requesting a reopen
+            self.open()
+            return
+        self.open()
+
+        if self.compress:
+            thread = threading.Thread(target=self.compress_segment,
+                                      args=(candidate,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.remove_old_segments()
+
+    def compress_segment(self, path):
+        # the segment may be removed as one of the oldest by another thread
+        # at any time
+        try:
+            with open(path, 'rb') as fin:
+                with gzip.open(path + '.gz.tmp', 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, 1024 * 1024)
+            os.replace(path + '.gz.tmp', path + '.gz')
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            sys.stderr.write('Error compressing log {0}: {1}\n'.format(
+                path, e))
+            try:
+                os.remove(path + '.gz.tmp')
+            except OSError:
+                pass
+        self.remove_old_segments()
+
+    def remove_old_segments(self):
+        dirname, basename = os.path.split(os.path.abspath(self.path))
+        pattern = re.compile(re.escape(basename) +
+                             r'\.(\d{8}-\d{6})(?:-(\d+))?(?:\.gz)?$')
+        segments = []
+        for name in os.listdir(dirname):
+            m = pattern.match(name)
+            if m is not None:
+                segments.append(((m.group(1), int(m.group(2) or 0)), name))
+        segments.sort()
+        for key, name in segments[:max(0, len(segments) -
+                                       self.backup_count)]:
+            try:
+                os.remove(os.path.join(dirname, name))
+            except OSError:
+                pass
+
+
+# The LogFile instances of this process that are reopened on SIGUSR1
+reopenable_log_files = []
+
+
+def reopen_log_files(signum=None, frame=None):
+    for log_file in reopenable_log_files:
+        log_file.request_reopen()
+
+
+def register_reopenable_log_file(log_file):
+    reopenable_log_files.append(log_file)
+    signal.signal(signal.SIGUSR1, reopen_log_files)
+
+
+class LogQueue:
+
+    ''' A bounded queue of log records with a file-like write() method. When
+        max_records records are queued, writers either wait for the log
+        writer to catch up (overflow 'block') or their records are dropped and
+        counted (overflow 'drop').
+    '''
+
+    def __init__(self, max_records, overflow='block'):
+        self.max_records = max_records
+        self.overflow = overflow
+        self.records = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
 
     def write(self, data):
-        self.queue.put(data)
+        with self.lock:
+            while len(self.records) >= self.max_records:
+                if self.overflow == 'drop':
+                    self.dropped += 1
+                    return
+                self.not_full.wait()
+            self.records.append(data)
+            if len(self.records) == 1:
+                self.not_empty.notify()
+
+    def take_all(self, timeout=None):
+        ''' Waits up to timeout seconds for records to be queued and returns
+            all of them together with the number of records dropped since the
+            last call.
+        '''
+        with self.lock:
+            if not self.records and not self.dropped:
+                self.not_empty.wait(timeout)
+            records = self.records
+            dropped = self.dropped
+            self.records = []
+            self.dropped = 0
+            self.not_full.notify_all()
+        return records, dropped
+
+
+class LogWriterThread(threading.Thread):
+
+    ''' Writes the records of a LogQueue to log_file. Each wakeup drains all
+        queued records and writes them at once. If should_flush is set, the
+        file is flushed after each batch, otherwise once flush_size bytes
+        have been written since the last flush or after flush_interval
+        seconds. If max_write_size is set, each write is flushed separately
+        and consists of whole records of at most that size in total, so that
+        writes to a pipe shared with other processes are atomic. Errors
+        writing the log are reported to stderr and the records of the failed
+        batch are counted as lost, but the queue keeps being drained so that
+        request threads never wait for a writer that has died.
+    '''
 
+    def __init__(self, log_file, queue, should_flush=False,
+                 flush_size=64 * 1024, flush_interval=1,
+                 max_write_size=None):
+        super().__init__()
+        self.log_file = log_file
+        self.queue = queue
+        self.should_flush = should_flush
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_write_size = max_write_size
+        self.lost = 0
+
+    def report_error(self, e, count):
+        # only the first error of a series is reported
+        if self.lost == 0:
+            sys.stderr.write('Error writing log: {0}\n'.format(e))
+        self.lost += count
+
+    def split_writes(self, records):
+        if self.max_write_size is None:
+            yield ''.join(records)
+            return
+        batch = []
+        batch_size = 0
+        for record in records:
+            size = len(record.encode('UTF-8'))
+            if batch and batch_size + size > self.max_write_size:
+                yield ''.join(batch)
+                batch = []
+                batch_size = 0
+            batch.append(record)
+            batch_size += size
+        if batch:
+            yield ''.join(batch)
 
-def setup_log(log_path, should_flush_log):
+    def run(self):
+        unflushed = 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = None
+            if unflushed > 0:
+                timeout = max(0, last_flush + self.flush_interval -
+                              time.monotonic())
+            records, dropped = self.queue.take_all(timeout)
+            count = len(records) + dropped
+            try:
+                records = [r if isinstance(r, str)
+                           else format_access_record(r) for r in records]
+                if dropped:
+                    records.append('dropped {0} log records\n'.format(
+                        dropped))
+                if self.lost and count:
+                    records.insert(0, 'lost {0} log records\n'.format(
+                        self.lost))
+
+                for data in self.split_writes(records):
+                    self.log_file.write(data)
+                    unflushed += len(data)
+                    if self.max_write_size is not None:
+                        self.log_file.flush()
+                        unflushed = 0
+
+                now = time.monotonic()
+                if unflushed > 0 and (self.should_flush or
+                                      unflushed >= self.flush_size or
+                                      now - last_flush >=
+                                      self.flush_interval):
+                    self.log_file.flush()
+                    unflushed = 0
+                if count:
+                    self.lost = 0
+            except Exception as e:
+                self.report_error(e, count)
+                # whatever is still buffered is retried by the next flush
+                unflushed = 0
+                now = time.monotonic()
+            if unflushed == 0:
+                last_flush = now
+
+
+def start_log_thread(log_file, should_flush_log, options=None,
+                     max_write_size=None):
+    if options is None:
+        options = default_server_options
+    log_queue = LogQueue(options.log_queue_size, options.log_overflow)
+    log_thread = LogWriterThread(log_file, log_queue,
+                                 should_flush=should_flush_log,
+                                 flush_size=options.log_buffer_size,
+                                 max_write_size=max_write_size)
+    log_thread.setDaemon(True)
+    log_thread.start()
+    return log_queue
+
+
+def setup_log(log_path, should_flush_log, options=None):
+    if options is None:
+        options = default_server_options
     if log_path is not None:
-        log_file = open(log_path, 'w')
+        log_file = LogFile(log_path, options.log_buffer_size,
+                           options.log_max_size, options.log_rotate_interval,
+                           options.log_backup_count, options.log_compress)
+        register_reopenable_log_file(log_file)
     else:
         log_file = sys.stdout
 
-    log_thread = PrintThread(log_file, should_flush=should_flush_log)
-    log_thread.setDaemon(True)
-    log_thread.start()
-    return FileQueueWrapper(log_thread.queue)
+    return start_log_thread(log_file, should_flush_log, options)
 
 
-def create_socket(host, port):
+def setup_access_log(options):
+    ''' Opens the access log of the current process. Worker processes append
+        to the same file, each write consisting of whole records.
+    '''
+    if options.access_log_path is None:
+        return None
+    log_file = LogFile(options.access_log_path, options.log_buffer_size)
+    register_reopenable_log_file(log_file)
+    return start_log_thread(log_file, False, options,
+                            max_write_size=options.log_buffer_size)
+
+
+def create_socket(host, port, reuse_port=False):
     addr = (host, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind(addr)
     sock.listen(5)
     return sock
@@ -389,17 +3037,24 @@ class ExternalSocketHTTPServer(HTTPServer):
 
 
 class ListenerThread(threading.Thread):
-    def __init__(self, host, port, socket, log_file, log_headers, auth_config):
+    def __init__(self, host, port, socket, log_file, log_headers,
+                 access_config, options=None, listing_cache=None,
+                 access_log=None, file_cache=None, compressed_cache=None):
         super().__init__()
         self.host = host
         self.port = port
         self.socket = socket
         self.log_file = log_file
+        self.access_log = access_log
+        self.file_cache = file_cache
+        self.compressed_cache = compressed_cache
         self.log_headers = log_headers
-        self.auth_config = auth_config
+        self.access_config = access_config
+        self.options = options
+        self.listing_cache = listing_cache
 
     def run(self):
-        if self.auth_config is None:
+        if self.access_config is None:
             server = ExternalSocketHTTPServer((self.host, self.port),
                                               SimpleHTTPFileServer,
                                               self.socket)
@@ -407,59 +3062,379 @@ class ListenerThread(threading.Thread):
             server = ExternalSocketHTTPServer((self.host, self.port),
                                               AuthSimpleHTTPFileServer,
                                               self.socket)
-            server.auth_config = self.auth_config
+            server.access_config = self.access_config
 
         server.log_file = self.log_file
         server.log_headers = self.log_headers
+        server.options = self.options
+        server.listing_cache = self.listing_cache
+        server.access_log = self.access_log
+        server.file_cache = self.file_cache
+        server.compressed_cache = self.compressed_cache
         server.serve_forever()
 
 
-def setup_and_start_http_server(host, port, access_config_path,
-                                should_log_headers, log_path, should_flush_log,
-                                num_threads):
-    log_file = setup_log(log_path, should_flush_log)
+class LogPipeThread(threading.Thread):
+    def __init__(self, pipe_file, log_file):
+        super().__init__()
+        self.pipe_file = pipe_file
+        self.log_file = log_file
 
-    socket = create_socket(host, port)
+    def run(self):
+        for line in self.pipe_file:
+            self.log_file.write(line)
 
-    auth_config = None
-    if access_config_path is not None:
-        if not os.path.exists(access_config_path):
-            log_file.write('No such file: {0}\n'.format(access_config_path))
-            sys.exit(1)
-        log_file.write('Setting up access restrictions\n')
-        auth_config = AuthConfig()
-        auth_config.load_config(access_config_path)
+
+class WorkerSupervisor:
+
+    ''' Runs the server in several forked worker processes and restarts the
+        workers that exit. The log output of the workers is forwarded through
+        a pipe to the log of the supervisor.
+    '''
+
+    def __init__(self, num_workers, run_worker, log_file, options=None,
+                 access_config=None):
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.log_file = log_file
+        self.options = options
+        self.access_config = access_config
+        self.workers = {}
+        self.log_pipe_read = None
+        self.log_pipe_write = None
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                # until the worker installs its own handlers
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+                # the log of the supervisor is not written by workers
+                del reopenable_log_files[:]
+                os.close(self.log_pipe_read)
+                # Writes of at most PIPE_BUF bytes to the pipe are atomic, so
+                # output of the workers is not interleaved
+                log_file = start_log_thread(
+                    os.fdopen(self.log_pipe_write, 'w'), True, self.options,
+                    max_write_size=select.PIPE_BUF)
+                self.run_worker(log_file)
+            finally:
+                os._exit(1)
+        self.workers[pid] = time.monotonic()
+
+    def terminate(self, signum, frame):
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sys.exit(0)
+
+    def forward_signal(self, signum, frame):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reopen_logs(self, signum, frame):
+        reopen_log_files()
+        self.forward_signal(signum, frame)
+
+    def reload_access_config(self, signum, frame):
+        # restarted workers are forked with the config of the supervisor
+        if self.access_config is not None:
+            self.access_config.reload()
+        self.forward_signal(signum, frame)
+
+    def run(self):
+        self.log_pipe_read, self.log_pipe_write = os.pipe()
+        log_thread = LogPipeThread(os.fdopen(self.log_pipe_read, 'r'),
+                                   self.log_file)
+        log_thread.setDaemon(True)
+        log_thread.start()
+
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGINT, self.terminate)
+        signal.signal(signal.SIGHUP, self.reload_access_config)
+        signal.signal(signal.SIGUSR1, self.reopen_logs)
+
+        for i in range(self.num_workers):
+            self.start_worker()
+
+        while True:
+            pid, status = os.wait()
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            self.log_file.write('worker {0} exited with status {1}, '
+                                'restarting\n'.format(pid, status))
+            if time.monotonic() - started < 1:
+                # avoid busy looping if workers fail right after start
+                time.sleep(1)
+            self.start_worker()
+
+
+class StatsThread(threading.Thread):
+    def __init__(self, log_file, interval, sources):
+        super().__init__()
+        self.log_file = log_file
+        self.interval = interval
+        self.sources = sources
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for source in self.sources:
+                self.log_file.write(source.stats() + '\n')
+
+
+def start_listeners(host, port, socket, log_file, should_log_headers,
+                    access_config, num_threads, options, engine):
+    if options is None:
+        options = default_server_options
+
+    if access_config is not None:
+        start_access_config_reload_thread(access_config, options)
+
+    access_log = setup_access_log(options)
+
+    listing_cache = None
+    if options.listing_cache_size > 0:
+        listing_cache = ListingCache(options.listing_cache_size)
+
+    file_cache = None
+    if options.file_cache_size > 0:
+        file_cache = FileCache(options.file_cache_size,
+                               options.file_cache_max_file_size)
+
+    compressed_cache = None
+    if options.compress and options.compress_cache_size > 0:
+        compressed_cache = CompressedFileCache(options.compress_cache_size)
+
+    stats_sources = [c for c in [listing_cache, file_cache, compressed_cache]
+                     if c is not None]
+    if options.stats_interval is not None and stats_sources:
+        stats_thread = StatsThread(log_file, options.stats_interval,
+                                   stats_sources)
+        stats_thread.setDaemon(True)
+        stats_thread.start()
+
+    if engine == 'asyncio':
+        log_file.write('listening on {0}:{1} using asyncio with {2} I/O '
+                       'threads\n'.format(host, port, num_threads))
+        server = AsyncHTTPFileServer(socket, log_file, should_log_headers,
+                                     access_config, num_threads, options,
+                                     listing_cache, access_log, file_cache,
+                                     compressed_cache)
+        server.serve_forever()
+        return
 
     log_file.write('listening on {0}:{1} using {2} threads\n'.format(
         host, port, num_threads))
 
     for i in range(num_threads):
         listener = ListenerThread(host, port, socket, log_file,
-                                  should_log_headers, auth_config)
+                                  should_log_headers, access_config, options,
+                                  listing_cache, access_log, file_cache,
+                                  compressed_cache)
         listener.setDaemon(True)
         listener.start()
     time.sleep(9e9)
 
 
+def setup_and_start_http_server(host, port, access_config_path,
+                                should_log_headers, log_path, should_flush_log,
+                                num_threads, options=None, engine='threads',
+                                num_workers=0, reuse_port=False):
+    log_file = setup_log(log_path, should_flush_log, options)
+
+    socket = None
+    if num_workers == 0 or not reuse_port:
+        socket = create_socket(host, port)
+
+    access_config = None
+    if access_config_path is not None:
+        if not os.path.exists(access_config_path):
+            log_file.write('No such file: {0}\n'.format(access_config_path))
+            sys.exit(1)
+        log_file.write('Setting up access restrictions\n')
+        access_config = AccessConfig(access_config_path, log_file)
+        if not access_config.load():
+            sys.exit(1)
+
+    if num_workers == 0:
+        start_listeners(host, port, socket, log_file, should_log_headers,
+                        access_config, num_threads, options, engine)
+        return
+
+    def run_worker(worker_log_file):
+        if access_config is not None:
+            # the queue of the supervisor is not drained in the worker
+            access_config.log_file = worker_log_file
+            # the file may have changed since the supervisor loaded it
+            access_config.reload_if_changed()
+        worker_socket = socket
+        if worker_socket is None:
+            worker_socket = create_socket(host, port, reuse_port=True)
+        start_listeners(host, port, worker_socket, worker_log_file,
+                        should_log_headers, access_config, num_threads,
+                        options, engine)
+
+    log_file.write('starting {0} worker processes\n'.format(num_workers))
+    WorkerSupervisor(num_workers, run_worker, log_file, options,
+                     access_config).run()
+
+
 def main():
     parser = argparse.ArgumentParser(prog='server.py')
     parser.add_argument('port', type=int, help="The port to listen on")
     parser.add_argument('--access_config', type=str, default=None,
                         help="Path to access config")
+    parser.add_argument('--access_config_poll_interval', type=float,
+                        default=None,
+                        help="If set, the access config is reloaded when it "
+                        "changes, checking every given number of seconds. "
+                        "The access config is also reloaded on SIGHUP")
     parser.add_argument('--log_headers', action='store_true', default=False,
                         help="If set logs headers of all requests")
     parser.add_argument('--log', type=str, default=None,
                         help="Path to log file")
+    parser.add_argument('--access_log', type=str, default=None,
+                        help="Path to a log file that receives one JSON "
+                        "object per request")
     parser.add_argument('--should_flush_log', action='store_true',
                         default=False,
-                        help="If set, flushes log to disk after each entry")
+                        help="If set, flushes log to disk after each batch "
+                        "of entries")
+    parser.add_argument('--log_max_size', type=int, default=None,
+                        help="If set, the log is rotated once it grows beyond "
+                        "the given number of bytes")
+    parser.add_argument('--log_rotate_interval', type=float, default=None,
+                        help="If set, the log is rotated every given number "
+                        "of seconds")
+    parser.add_argument('--log_backup_count', type=int, default=5,
+                        help="The number of rotated logs to keep")
+    parser.add_argument('--log_compress', action='store_true', default=False,
+                        help="If set, rotated logs are compressed with gzip")
+    parser.add_argument('--log_queue_size', type=int, default=64 * 1024,
+                        help="The maximum number of log entries waiting to be "
+                        "written")
+    parser.add_argument('--log_overflow', choices=['block', 'drop'],
+                        default='block',
+                        help="Whether requests wait or their log entries are "
+                        "dropped when the log queue is full")
     parser.add_argument('--threads', type=int, default=2,
                         help="The number of threads to launch")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        default='threads',
+                        help="The serving engine. 'threads' serves one "
+                        "connection per listener thread, 'asyncio' serves all "
+                        "connections from an event loop and uses the threads "
+                        "for file system operations and uploads")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="The number of worker processes to fork. If 0, "
+                        "requests are served by the main process")
+    parser.add_argument('--reuse_port', action='store_true', default=False,
+                        help="If set, each worker process listens on its own "
+                        "socket bound with SO_REUSEPORT instead of sharing a "
+                        "single socket")
+    parser.add_argument('--upload_buffer_size', type=int,
+                        default=1024 * 1024,
+                        help="The size of the buffer used to receive "
+                        "uploads, in bytes")
+    parser.add_argument('--atomic_put', action='store_true', default=False,
+                        help="If set, uploads are written to a temporary file "
+                        "that replaces the destination once complete")
+    parser.add_argument('--store_digests', action='store_true',
+                        default=False,
+                        help="If set, the SHA-256 digests of uploaded files "
+                        "are stored in extended attributes and returned by "
+                        "GET and HEAD")
+    parser.add_argument('--fsync', choices=['none', 'file', 'file+dir'],
+                        default='none',
+                        help="Whether uploaded files and their parent "
+                        "directory are synced to disk before the upload is "
+                        "acknowledged")
+    parser.add_argument('--listing_cache_size', type=int, default=0,
+                        help="The maximum total size of cached directory "
+                        "listings in bytes. 0 disables the cache")
+    parser.add_argument('--file_cache_size', type=int, default=0,
+                        help="The maximum total size of small files cached "
+                        "in memory in bytes. 0 disables the cache")
+    parser.add_argument('--file_cache_max_file_size', type=int,
+                        default=64 * 1024,
+                        help="The maximum size of a file to cache in memory, "
+                        "in bytes")
+    parser.add_argument('--precompressed', action='store_true',
+                        default=False,
+                        help="If set, files are served from their .br, .zst "
+                        "or .gz siblings if the client accepts the encoding")
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help="If set, small files are gzipped on the fly if "
+                        "the client accepts gzip")
+    parser.add_argument('--compress_max_file_size', type=int,
+                        default=1024 * 1024,
+                        help="The maximum size of a file to gzip on the fly, "
+                        "in bytes")
+    parser.add_argument('--compress_cache_size', type=int,
+                        default=16 * 1024 * 1024,
+                        help="The maximum total size of files gzipped on the "
+                        "fly that are kept in memory, in bytes")
+    parser.add_argument('--stats_interval', type=float, default=None,
+                        help="If set, cache statistics are logged every "
+                        "given number of seconds")
+    parser.add_argument('--disable_sendfile', action='store_true',
+                        default=False,
+                        help="If set, file contents are copied through "
+                        "userspace buffers instead of using sendfile()")
+    parser.add_argument('--keep_alive', action='store_true', default=False,
+                        help="If set, uses HTTP/1.1 and keeps connections "
+                        "open between requests")
+    parser.add_argument('--max_keep_alive_requests', type=int, default=100,
+                        help="The maximum number of requests served over a "
+                        "single connection")
+    parser.add_argument('--idle_timeout', type=float, default=30,
+                        help="The number of seconds to wait for a request, "
+                        "or for a stalled transfer to make progress, before "
+                        "closing the connection")
     args = parser.parse_args()
 
+    options = ServerOptions()
+    options.use_sendfile = not args.disable_sendfile
+    options.keep_alive = args.keep_alive
+    options.max_keep_alive_requests = args.max_keep_alive_requests
+    options.idle_timeout = args.idle_timeout
+    options.upload_buffer_size = args.upload_buffer_size
+    options.atomic_put = args.atomic_put
+    options.store_digests = args.store_digests
+    options.fsync_policy = args.fsync
+    options.listing_cache_size = args.listing_cache_size
+    options.file_cache_size = args.file_cache_size
+    options.file_cache_max_file_size = args.file_cache_max_file_size
+    options.precompressed = args.precompressed
+    options.compress = args.compress
+    options.compress_max_file_size = args.compress_max_file_size
+    options.compress_cache_size = args.compress_cache_size
+    options.stats_interval = args.stats_interval
+    options.access_config_poll_interval = args.access_config_poll_interval
+    options.log_max_size = args.log_max_size
+    options.log_rotate_interval = args.log_rotate_interval
+    options.log_backup_count = args.log_backup_count
+    options.log_compress = args.log_compress
+    options.log_queue_size = args.log_queue_size
+    options.log_overflow = args.log_overflow
+    options.access_log_path = args.access_log
+
     setup_and_start_http_server('localhost', args.port, args.access_config,
                                 args.log_headers, args.log,
-                                args.should_flush_log, args.threads)
+                                args.should_flush_log, args.threads, options,
+                                args.engine, args.workers, args.reuse_port)
 
 
 if __name__ == '__main__':
@@ -15,19 +15,37 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import base64
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import os
+import random
 import shutil
+import signal
+import socket
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import unittest
+import unittest.mock
+import zipfile
 from http import HTTPStatus
 
 import requests
 
+import server
+
 
 class TestFixture(unittest.TestCase):
-    def setUp(self, port=8080, perm_path=None, perms_json=None):
+    server_args = []
+
+    def setUp(self, port=8080, perm_path=None, perms_json=None,
+              extra_args=None):
         self.process = None
         self.port = port
 
@@ -44,6 +62,12 @@ class TestFixture(unittest.TestCase):
             perm_path = os.path.abspath(perm_path)
             cmd += ['--access_config', perm_path]
 
+        cmd += self.server_args
+        if extra_args is not None:
+            cmd += extra_args
+        if 'asyncio' in cmd and sys.version_info < (3, 7):
+            self.skipTest('The asyncio engine requires Python 3.7')
+
         self.root = os.path.join(file_dir, "tmp_tests_dir")
         if os.path.exists(self.root):
             shutil.rmtree(self.root)
@@ -75,6 +99,14 @@ class TestFixture(unittest.TestCase):
             self.assertEqual(expected_text, r.text,
                              'Incorrect GET text for url {0}'.format(url))
 
+    def get(self, path, headers=None):
+        url = "http://localhost:" + str(self.port) + "/" + path
+        return requests.get(url, headers=headers)
+
+    def head(self, path, headers=None):
+        url = "http://localhost:" + str(self.port) + "/" + path
+        return requests.head(url, headers=headers)
+
     def assert_put(self, path, expected_status, data, user=None, psw=None):
         url = "http://localhost:" + str(self.port) + "/" + path
         if user is not None and psw is not None:
@@ -120,6 +152,1803 @@ class TestNoAuth(TestFixture):
         self.assert_get('', HTTPStatus.OK, '{"dir": "directory", "ff": "file"}')
 
 
+class TestLargeFile(TestFixture):
+    def check_large_file(self):
+        text = ''.join(str(i % 10) for i in range(1024 * 1024 + 17))
+        self.put_file('large', text)
+        self.assert_get('large', HTTPStatus.OK, text)
+        self.assert_put('dir/large', HTTPStatus.OK, text)
+        self.assert_get('dir/large', HTTPStatus.OK, text)
+
+    def test_large_file(self):
+        self.check_large_file()
+
+
+class TestLargeFileNoSendfile(TestLargeFile):
+    server_args = ['--disable_sendfile']
+
+
+class TestLargeFileAsyncio(TestLargeFile):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestLargeFileAsyncioNoSendfile(TestLargeFile):
+    server_args = ['--engine', 'asyncio', '--disable_sendfile']
+
+
+class TestLargeFileSmallBuffer(TestLargeFile):
+    server_args = ['--upload_buffer_size', '1000']
+
+
+class TestTruncatedUpload(TestFixture):
+    def put_truncated(self, path):
+        sock = socket.create_connection(('localhost', self.port))
+        sock.sendall('PUT /{0} HTTP/1.0\r\n'
+                     'Content-Length: 100\r\n\r\n'.format(path).encode())
+        sock.sendall(b'1' * 10)
+        sock.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        return response
+
+    def test_truncated_upload(self):
+        response = self.put_truncated('ff')
+        self.assertTrue(response.startswith(b'HTTP/1.0 400'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'ff')))
+
+    def test_concurrent_truncated_uploads(self):
+        socks = []
+        for i in range(2):
+            sock = socket.create_connection(('localhost', self.port))
+            sock.sendall(b'PUT /ff HTTP/1.0\r\nContent-Length: 100\r\n\r\n')
+            sock.sendall(b'1' * 10)
+            socks.append(sock)
+        time.sleep(0.2)
+        # the second failed upload does not fail to remove the file again
+        for sock in socks:
+            sock.shutdown(socket.SHUT_WR)
+            response = b''
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+            sock.close()
+            self.assertTrue(response.startswith(b'HTTP/1.0 400'), response)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'ff')))
+
+
+class TestTruncatedUploadAsyncio(TestTruncatedUpload):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestAtomicPut(TestTruncatedUpload):
+    server_args = ['--atomic_put', '--fsync', 'file+dir']
+
+    def test_atomic_put(self):
+        self.put_file('dir/ff', 'old')
+        response = self.put_truncated('dir/ff')
+        self.assertTrue(response.startswith(b'HTTP/1.0 400'))
+        self.assert_get_path('dir/ff', 'old')
+        self.assertEqual(['ff'], os.listdir(os.path.join(self.root, 'dir')))
+
+        self.assert_put('dir/ff', HTTPStatus.OK, 'new')
+        self.assert_get_path('dir/ff', 'new')
+        self.assertEqual(['ff'], os.listdir(os.path.join(self.root, 'dir')))
+        self.assert_put('dir/ff2', HTTPStatus.OK, 'new2')
+        self.assert_get('dir/ff2', HTTPStatus.OK, 'new2')
+
+
+class TestChunkedUpload(TestFixture):
+    def test_chunked_upload(self):
+        url = "http://localhost:" + str(self.port) + "/dir/ff"
+        chunks = [b'12', b'345', b'', b'6' * 100000]
+        r = requests.put(url, data=iter(chunks))
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assert_get_path('dir/ff', '12345' + '6' * 100000)
+
+    def test_chunked_upload_raw(self):
+        sock = socket.create_connection(('localhost', self.port))
+        sock.sendall(b'PUT /ff HTTP/1.1\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n'
+                     b'3;ext=1\r\nabc\r\nA\r\n0123456789\r\n'
+                     b'0\r\nTrailer: 1\r\n\r\n')
+        self.assertTrue(sock.recv(4096).startswith(b'HTTP/1.0 200'))
+        sock.close()
+        self.assert_get_path('ff', 'abc0123456789')
+
+    def test_no_length(self):
+        sock = socket.create_connection(('localhost', self.port))
+        sock.sendall(b'PUT /ff HTTP/1.1\r\n\r\n')
+        self.assertTrue(sock.recv(4096).startswith(b'HTTP/1.0 411'))
+        sock.close()
+
+
+class TestChunkedUploadAsyncio(TestChunkedUpload):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestExpectContinue(TestFixture):
+    server_args = ['--keep_alive']
+
+    def setUp(self):
+        perms_json = '''
+{
+    "paths" : [
+        { "path" : ".", "user" : "*", "perms" : "" },
+        { "path" : "w", "user" : "*", "perms" : "w" }
+    ],
+    "users" : []
+}
+'''
+        super().setUp(perms_json=perms_json)
+
+    def put_expect_continue(self, path):
+        sock = socket.create_connection(('localhost', self.port))
+        sock.sendall('PUT /{0} HTTP/1.1\r\n'
+                     'Content-Length: 3\r\n'
+                     'Expect: 100-continue\r\n\r\n'.format(path).encode())
+        sock.settimeout(1)
+        try:
+            response = sock.recv(4096)
+        except socket.timeout:
+            # like other clients, send the body if no response arrives
+            response = b''
+        sock.settimeout(None)
+        if not response or response.split(b' ')[1] == b'100':
+            sock.sendall(b'123')
+            response += sock.recv(4096)
+        sock.close()
+        return response
+
+    def test_expect_continue(self):
+        response = self.put_expect_continue('ff')
+        self.assertEqual(b'401', response.split(b' ')[1])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'ff')))
+
+        response = self.put_expect_continue('w/ff')
+        self.assertEqual(b'100', response.split(b' ')[1])
+        self.assertIn(b'\r\n\r\nHTTP/1.', response)
+        final_response = response.split(b'\r\n\r\n')[1]
+        self.assertEqual(b'200', final_response.split(b' ')[1])
+        self.assert_get_path('w/ff', '123')
+
+
+class TestExpectContinueAsyncio(TestExpectContinue):
+    server_args = ['--engine', 'asyncio', '--keep_alive']
+
+
+class TestExpectContinueHTTP10(TestExpectContinue):
+    server_args = []
+
+    def test_expect_continue(self):
+        response = self.put_expect_continue('ff')
+        self.assertEqual(b'401', response.split(b' ')[1])
+
+        # no interim response is sent by an HTTP/1.0 server
+        response = self.put_expect_continue('w/ff')
+        self.assertTrue(response.startswith(b'HTTP/1.0 200'))
+        self.assert_get_path('w/ff', '123')
+
+
+class TestRanges(TestFixture):
+    def test_ranges(self):
+        self.put_file('ff', '0123456789')
+
+        r = self.get('ff')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('bytes', r.headers['Accept-Ranges'])
+        last_modified = r.headers['Last-Modified']
+
+        r = self.get('ff', {'Range': 'bytes=2-4'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        self.assertEqual('bytes 2-4/10', r.headers['Content-Range'])
+        self.assertEqual('234', r.text)
+
+        r = self.get('ff', {'Range': 'bytes=7-'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        self.assertEqual('789', r.text)
+
+        r = self.get('ff', {'Range': 'bytes=-2'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        self.assertEqual('89', r.text)
+
+        r = self.get('ff', {'Range': 'bytes=5-100'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        self.assertEqual('bytes 5-9/10', r.headers['Content-Range'])
+        self.assertEqual('56789', r.text)
+
+        r = self.get('ff', {'Range': 'bytes=0-1,8-9'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        content_type = r.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges'))
+        boundary = content_type.split('boundary=')[1]
+        self.assertEqual(int(r.headers['Content-Length']), len(r.content))
+        parts = r.text.split('--' + boundary)
+        self.assertEqual(4, len(parts))
+        self.assertIn('Content-Range: bytes 0-1/10', parts[1])
+        self.assertTrue(parts[1].endswith('\r\n\r\n01\r\n'))
+        self.assertIn('Content-Range: bytes 8-9/10', parts[2])
+        self.assertTrue(parts[2].endswith('\r\n\r\n89\r\n'))
+        self.assertEqual('--\r\n', parts[3])
+
+        r = self.get('ff', {'Range': 'bytes=10-'})
+        self.assertEqual(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                         r.status_code)
+        self.assertEqual('bytes */10', r.headers['Content-Range'])
+
+        r = self.get('ff', {'Range': 'bytes=a-b'})
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('0123456789', r.text)
+
+        r = self.get('ff', {'Range': 'bytes=2-4', 'If-Range': last_modified})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        self.assertEqual('234', r.text)
+
+        r = self.get('ff', {'Range': 'bytes=2-4',
+                            'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('0123456789', r.text)
+
+
+class TestRangesNoSendfile(TestRanges):
+    server_args = ['--disable_sendfile']
+
+
+class TestRangesAsyncio(TestRanges):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestRangesAsyncioNoSendfile(TestRanges):
+    server_args = ['--engine', 'asyncio', '--disable_sendfile']
+
+
+class TestWorkers(TestFixture):
+    server_args = ['--workers', '2']
+
+    def get_worker_pids(self):
+        output = subprocess.check_output(['pgrep', '-P',
+                                          str(self.process.pid)])
+        return [int(pid) for pid in output.split()]
+
+    def test_workers(self):
+        self.assert_put('ff', HTTPStatus.OK, '1')
+        for i in range(10):
+            self.assert_get('ff', HTTPStatus.OK, '1')
+
+        pids = self.get_worker_pids()
+        self.assertEqual(2, len(pids))
+        os.kill(pids[0], signal.SIGKILL)
+        for i in range(50):
+            time.sleep(0.1)
+            new_pids = self.get_worker_pids()
+            if len(new_pids) == 2:
+                break
+        self.assertEqual(2, len(new_pids))
+        self.assertNotIn(pids[0], new_pids)
+        for i in range(10):
+            self.assert_get('ff', HTTPStatus.OK, '1')
+
+
+class TestWorkersReusePort(TestWorkers):
+    server_args = ['--workers', '2', '--reuse_port']
+
+
+class TestWorkersAsyncio(TestWorkers):
+    server_args = ['--workers', '2', '--engine', 'asyncio']
+
+
+class TestLogQueue(unittest.TestCase):
+
+    def test_drop(self):
+        log_queue = server.LogQueue(2, 'drop')
+        for i in range(5):
+            log_queue.write('{0}\n'.format(i))
+        self.assertEqual((['0\n', '1\n'], 3), log_queue.take_all())
+        self.assertEqual(([], 0), log_queue.take_all(0))
+
+    def test_block(self):
+        log_queue = server.LogQueue(2, 'block')
+        log_file = io.StringIO()
+        for i in range(100):
+            log_queue.write('{0}\n'.format(i))
+            if i == 1:
+                # writers wait until the records are written
+                writer = server.LogWriterThread(log_file, log_queue, True)
+                writer.daemon = True
+                writer.start()
+        for i in range(50):
+            if log_file.getvalue().count('\n') == 100:
+                break
+            time.sleep(0.1)
+        self.assertEqual(''.join('{0}\n'.format(i) for i in range(100)),
+                         log_file.getvalue())
+
+    def test_write_error(self):
+        class FailingFile(io.StringIO):
+            failures = 2
+
+            def write(self, data):
+                if self.failures > 0:
+                    self.failures -= 1
+                    raise OSError('No space left on device')
+                return super().write(data)
+
+        log_queue = server.LogQueue(2, 'block')
+        log_file = FailingFile()
+        writer = server.LogWriterThread(log_file, log_queue, True)
+        writer.daemon = True
+        writer.start()
+        for i in range(3):
+            log_queue.write('{0}\n'.format(i))
+            time.sleep(0.1)
+        # the writer keeps draining the queue after errors
+        for i in range(3, 100):
+            log_queue.write('{0}\n'.format(i))
+        for i in range(50):
+            if log_file.getvalue().endswith('99\n'):
+                break
+            time.sleep(0.1)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual('lost 2 log records\n' +
+                         ''.join('{0}\n'.format(i) for i in range(2, 100)),
+                         log_file.getvalue())
+
+    def test_split_writes(self):
+        writer = server.LogWriterThread(None, None, max_write_size=10)
+        self.assertEqual(['aaaa\nbbbb\n', 'cccccccccccc\n', 'd\n'],
+                         list(writer.split_writes(['aaaa\n', 'bbbb\n',
+                                                   'cccccccccccc\n',
+                                                   'd\n'])))
+
+
+class TestAuthConfig(unittest.TestCase):
+
+    def make_config(self):
+        config = server.AuthConfig(io.StringIO())
+        config.add_path_config('.', '*', 'l')
+        config.add_path_config('a', 'user1', 'rw')
+        config.add_path_config('a/public', '*', 'rl')
+        config.users['user1'] = 'pass1'
+        config.users['user2'] = 'pass2'
+        return config
+
+    def test_inheritance(self):
+        config = self.make_config()
+        self.assertTrue(config.check_user_perm('a/b/c', 'r', 'user1'))
+        self.assertTrue(config.check_user_perm('a/b/c', 'w', 'user1'))
+        # a user entry replaces the inherited permissions
+        self.assertFalse(config.check_user_perm('a/b/c', 'l', 'user1'))
+        self.assertTrue(config.check_user_perm('a/b/c', 'l', '*'))
+        self.assertFalse(config.check_user_perm('a/b/c', 'r', '*'))
+        # and a "*" entry below it replaces them for all users
+        self.assertTrue(config.check_user_perm('a/public/f', 'l', 'user1'))
+        self.assertFalse(config.check_user_perm('a/public/f', 'w', 'user1'))
+
+    def test_star_fallback(self):
+        config = self.make_config()
+        # users that appear in no path have the permissions of "*"
+        for path in ['.', 'a', 'a/b', 'a/public/f']:
+            for perm in 'rwl':
+                self.assertEqual(config.check_user_perm(path, perm, '*'),
+                                 config.check_user_perm(path, perm, 'user2'))
+        self.assertEqual('user2', config.get_effective_user('user2', 'pass2'))
+        self.assertIsNone(config.get_effective_user('user2', 'wrong'))
+        self.assertEqual('*', config.get_effective_user('unknown', 'x'))
+
+    def test_recompile(self):
+        config = self.make_config()
+        self.assertFalse(config.check_user_perm('a/b', 'r', 'user2'))
+        walker = config.get_perm_walker('a', 'r', 'user2').child('b')
+        self.assertFalse(walker.allowed())
+
+        # the cached decisions are dropped when the configuration changes
+        config.add_path_config('a/b', 'user2', 'r')
+        self.assertTrue(config.check_user_perm('a/b', 'r', 'user2'))
+        self.assertTrue(config.check_user_perm('a/b/c', 'r', 'user2'))
+        self.assertTrue(config.check_user_perm('a/b', 'w', 'user1'))
+        self.assertFalse(config.check_user_perm('a/b', 'r', '*'))
+        walker = config.get_perm_walker('a', 'r', 'user2').child('b')
+        self.assertTrue(walker.allowed())
+
+    def reference_check(self, entries, path, perm, user):
+        # the permissions of the deepest configured path on the way apply
+        perms = 'rwl'
+        prefix = ''
+        for name in [''] + path.split('/'):
+            prefix = prefix + '/' + name if prefix or name else ''
+            if (prefix, user) in entries:
+                perms = entries[(prefix, user)]
+            elif (prefix, '*') in entries:
+                perms = entries[(prefix, '*')]
+        return perm in perms
+
+    def test_random_configs(self):
+        rng = random.Random(1)
+        names = ['a', 'b', 'c']
+        users = ['*', 'user1', 'user2', 'user3']
+        for i in range(50):
+            config = server.AuthConfig(io.StringIO())
+            entries = {}
+            for j in range(rng.randint(0, 8)):
+                path = '/'.join(rng.choice(names)
+                                for k in range(rng.randint(0, 3)))
+                user = rng.choice(users[:3])
+                perms = ''.join(p for p in 'rwl' if rng.random() < 0.5)
+                config.add_path_config(path, user, perms)
+                entries[('/' + path if path else '', user)] = perms
+
+            for j in range(100):
+                path = '/'.join(rng.choice(names)
+                                for k in range(rng.randint(1, 4)))
+                perm = rng.choice('rwl')
+                user = rng.choice(users)
+                self.assertEqual(
+                    self.reference_check(entries, path, perm, user),
+                    config.check_user_perm(path, perm, user),
+                    '{0} {1} {2} {3}'.format(entries, path, perm, user))
+
+
+class TestLogFile(TestFixture):
+
+    def setUp(self):
+        self.log_path = os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'tmp_tests_log.txt')
+        super().setUp(extra_args=['--log', self.log_path] + self.log_args)
+
+    def tearDown(self):
+        super().tearDown()
+        os.remove(self.log_path)
+
+    log_args = ['--should_flush_log']
+
+    def test_log(self):
+        self.assert_put('ff', HTTPStatus.OK, '1')
+        for i in range(20):
+            self.assert_get('ff', HTTPStatus.OK, '1')
+        for i in range(50):
+            with open(self.log_path) as log_file:
+                text = log_file.read()
+            if text.count('"GET /ff HTTP/1.1" 200') == 20:
+                break
+            time.sleep(0.1)
+        self.assertEqual(20, text.count('"GET /ff HTTP/1.1" 200'))
+        self.assertIn('"PUT /ff HTTP/1.1" 200', text)
+
+
+class TestLogFileTimedFlush(TestLogFile):
+    log_args = []
+
+
+class TestLogFileWorkers(TestLogFile):
+    log_args = ['--workers', '2']
+
+
+class TestLogRotation(TestFixture):
+
+    log_args = ['--log_max_size', '2000', '--log_backup_count', '3']
+
+    def setUp(self):
+        self.log_dir = os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'tmp_tests_logs')
+        if os.path.exists(self.log_dir):
+            shutil.rmtree(self.log_dir)
+        os.makedirs(self.log_dir)
+        self.log_path = os.path.join(self.log_dir, 'log.txt')
+        super().setUp(extra_args=['--log', self.log_path,
+                                  '--should_flush_log'] + self.log_args)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.log_dir)
+
+    def wait_for_segments(self, count, suffix=''):
+        for i in range(50):
+            segments = sorted(name for name in os.listdir(self.log_dir)
+                              if name != 'log.txt' and name.endswith(suffix))
+            if len(segments) == count:
+                return segments
+            time.sleep(0.1)
+        self.fail('Unexpected log segments: ' + str(segments))
+
+    def read_segment(self, name):
+        with open(os.path.join(self.log_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_rotation(self):
+        self.put_file('ff', '1')
+        for i in range(100):
+            self.assert_get('ff', HTTPStatus.OK, '1')
+        for name in self.wait_for_segments(3):
+            data = self.read_segment(name)
+            self.assertIn(b'"GET /ff HTTP/1.1" 200', data)
+            self.assertLess(len(data), 2200)
+
+    def test_reopen(self):
+        self.assert_put('ff', HTTPStatus.OK, '1')
+        time.sleep(0.5)
+        os.rename(self.log_path, self.log_path + '.moved')
+        self.process.send_signal(signal.SIGUSR1)
+        time.sleep(0.5)
+        self.assert_get('ff', HTTPStatus.OK, '1')
+        for i in range(50):
+            if os.path.exists(self.log_path):
+                with open(self.log_path) as f:
+                    text = f.read()
+                if '"GET /ff HTTP/1.1" 200' in text:
+                    break
+            time.sleep(0.1)
+        self.assertIn('"GET /ff HTTP/1.1" 200', text)
+        self.assertNotIn('"PUT /ff HTTP/1.1" 200', text)
+
+    def test_removed_log(self):
+        self.put_file('ff', '1')
+        self.assert_get('ff', HTTPStatus.OK, '1')
+        time.sleep(0.5)
+        # neither the rotation nor the log writer fail
+        os.remove(self.log_path)
+        for i in range(100):
+            self.assert_get('ff', HTTPStatus.OK, '1')
+        self.assertTrue(os.path.exists(self.log_path))
+
+
+class TestLogRotationCompress(TestLogRotation):
+    log_args = ['--log_max_size', '2000', '--log_backup_count', '3',
+                '--log_compress']
+
+    def read_segment(self, name):
+        with gzip.open(os.path.join(self.log_dir, name), 'rb') as f:
+            return f.read()
+
+    def wait_for_segments(self, count, suffix=''):
+        return super().wait_for_segments(count, '.gz')
+
+
+class TestLogRotationInterval(TestLogRotation):
+    log_args = ['--log_rotate_interval', '0.5']
+
+    def test_rotation(self):
+        self.assert_put('ff', HTTPStatus.OK, '1')
+        time.sleep(1)
+        self.assert_get('ff', HTTPStatus.OK, '1')
+        time.sleep(0.5)
+        # the startup message may be rotated separately
+        segments = [name for name in os.listdir(self.log_dir)
+                    if name != 'log.txt']
+        self.assertIn(len(segments), [1, 2])
+        self.assertIn(b'"PUT /ff HTTP/1.1" 200',
+                      b''.join(self.read_segment(name) for name in segments))
+        with open(self.log_path) as f:
+            self.assertIn('"GET /ff HTTP/1.1" 200', f.read())
+
+
+class TestLogRotationWorkers(TestLogRotation):
+    server_args = ['--workers', '2']
+
+
+class TestAccessLog(TestFixture):
+
+    perms_json = None
+
+    def setUp(self):
+        self.log_path = os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'tmp_tests_access_log.json')
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        super().setUp(perms_json=self.perms_json,
+                      extra_args=['--access_log', self.log_path])
+
+    def tearDown(self):
+        super().tearDown()
+        os.remove(self.log_path)
+
+    def read_access_log(self, count):
+        for i in range(50):
+            if os.path.exists(self.log_path):
+                with open(self.log_path) as log_file:
+                    records = [json.loads(line) for line in log_file]
+                if len(records) >= count:
+                    return records
+            time.sleep(0.1)
+        self.fail('Access log has too few records')
+
+    def test_access_log(self):
+        self.assert_put('ff', HTTPStatus.OK, '0123456789')
+        self.assert_get('ff', HTTPStatus.OK, '0123456789')
+        r = self.get('ff', headers={'Range': 'bytes=2-4'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+        self.assert_get('missing', HTTPStatus.NOT_FOUND)
+
+        records = self.read_access_log(4)
+        self.assertEqual(4, len(records))
+        for record in records:
+            self.assertEqual('127.0.0.1', record['client'])
+            self.assertIsNone(record['user'])
+            self.assertLessEqual(0, record['ttfb'])
+            self.assertLessEqual(record['ttfb'], record['duration'])
+
+        put, get, get_range, missing = records
+        self.assertEqual(['PUT', '/ff', 200, 10],
+                         [put['method'], put['path'], put['status'],
+                          put['bytes_in']])
+        self.assertEqual(['GET', '/ff', 200, 0],
+                         [get['method'], get['path'], get['status'],
+                          get['bytes_in']])
+        self.assertEqual(206, get_range['status'])
+        self.assertEqual(404, missing['status'])
+        # the headers are included
+        self.assertLess(10, get['bytes_out'])
+        self.assertLess(get['bytes_out'], 1000)
+
+    def test_access_log_large_file(self):
+        self.put_file('ff', 'a' * 1000000)
+        r = self.get('ff')
+        self.assertEqual(1000000, len(r.content))
+        r = self.get('')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+
+        records = {r['path']: r for r in self.read_access_log(2)}
+        get = records['/ff']
+        listing = records['/']
+        self.assertLess(1000000, get['bytes_out'])
+        self.assertLess(get['bytes_out'], 1001000)
+        self.assertLess(len(r.content), listing['bytes_out'])
+
+
+class TestAccessLogAsyncio(TestAccessLog):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestAccessLogWorkers(TestAccessLog):
+    server_args = ['--workers', '2']
+
+    def test_access_log(self):
+        for i in range(20):
+            self.assert_put('f' + str(i), HTTPStatus.OK, str(i))
+        # each worker appends its records separately
+        records = self.read_access_log(20)
+        self.assertEqual(['/f' + str(i) for i in range(20)],
+                         sorted((r['path'] for r in records),
+                                key=lambda p: int(p[2:])))
+
+
+class TestAccessLogAuth(TestAccessLog):
+    perms_json = json.dumps({
+        'paths': [
+            {'path': '.', 'user': '*', 'perms': 'rl'},
+            {'path': '.', 'user': 'user1', 'perms': 'rw'},
+        ],
+        'users': [{'user': 'user1', 'psw': 'pass1'}]
+    })
+
+    def test_access_log(self):
+        self.assert_put('ff', HTTPStatus.UNAUTHORIZED, '1')
+        self.assert_put('ff', HTTPStatus.OK, '1', user='user1', psw='pass1')
+        self.assert_get('ff', HTTPStatus.OK, '1')
+        self.assert_get('ff', HTTPStatus.UNAUTHORIZED,
+                        user='user1', psw='pass2')
+        records = self.read_access_log(4)
+        self.assertEqual([(401, '*'), (200, 'user1'), (200, '*'),
+                          (401, None)],
+                         [(r['status'], r['user']) for r in records])
+
+
+class TestConditional(TestFixture):
+    def test_conditional(self):
+        self.put_file('ff', '1')
+
+        r = self.get('ff')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        etag = r.headers['ETag']
+        last_modified = r.headers['Last-Modified']
+
+        for method in [self.get, self.head]:
+            r = method('ff', {'If-None-Match': etag})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, r.status_code)
+            self.assertEqual(etag, r.headers['ETag'])
+            self.assertEqual('', r.text)
+
+            r = method('ff', {'If-None-Match': '"other", W/' + etag})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, r.status_code)
+
+            r = method('ff', {'If-None-Match': '*'})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, r.status_code)
+
+            r = method('ff', {'If-None-Match': '"other"'})
+            self.assertEqual(HTTPStatus.OK, r.status_code)
+
+            r = method('ff', {'If-Modified-Since': last_modified})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, r.status_code)
+
+            r = method('ff', {'If-Modified-Since':
+                              'Thu, 01 Jan 1970 00:00:00 GMT'})
+            self.assertEqual(HTTPStatus.OK, r.status_code)
+
+            r = method('ff', {'If-None-Match': '"other"',
+                              'If-Modified-Since': last_modified})
+            self.assertEqual(HTTPStatus.OK, r.status_code)
+
+        r = self.get('ff', {'Range': 'bytes=0-0', 'If-Range': etag})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status_code)
+
+        self.put_file('ff', '22')
+        r = self.get('ff', {'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('22', r.text)
+        self.assertNotEqual(etag, r.headers['ETag'])
+
+
+class TestKeepAlive(TestFixture):
+    def setUp(self):
+        super().setUp(extra_args=['--keep_alive',
+                                  '--max_keep_alive_requests', '4',
+                                  '--idle_timeout', '1'])
+
+    def request(self, conn, method, path, body=None):
+        conn.request(method, '/' + path, body=body)
+        r = conn.getresponse()
+        return (r.status, r.read(), r.getheader('Connection'))
+
+    def test_keep_alive(self):
+        self.put_file('ff', '1')
+
+        conn = http.client.HTTPConnection('localhost', self.port)
+        self.assertEqual((HTTPStatus.OK, b'1', None),
+                         self.request(conn, 'GET', 'ff'))
+        sock = conn.sock
+        self.assertEqual((HTTPStatus.OK, b'', None),
+                         self.request(conn, 'PUT', 'ff2', body=b'22'))
+        self.assertEqual((HTTPStatus.OK, b'{"ff": "file", "ff2": "file"}',
+                          None),
+                         self.request(conn, 'GET', ''))
+        self.assertIs(sock, conn.sock)
+        self.assertEqual((HTTPStatus.OK, b'22', 'close'),
+                         self.request(conn, 'GET', 'ff2'))
+        conn.close()
+
+    def test_redirect_and_error(self):
+        self.put_dir('dir')
+
+        conn = http.client.HTTPConnection('localhost', self.port)
+        status, _, connection = self.request(conn, 'GET', 'dir')
+        self.assertEqual(HTTPStatus.MOVED_PERMANENTLY, status)
+        self.assertIsNone(connection)
+        sock = conn.sock
+        self.assertEqual((HTTPStatus.OK, b'{}', None),
+                         self.request(conn, 'GET', 'dir/'))
+        self.assertIs(sock, conn.sock)
+        status, _, connection = self.request(conn, 'GET', 'missing')
+        self.assertEqual(HTTPStatus.NOT_FOUND, status)
+        self.assertEqual('close', connection)
+        conn.close()
+
+    def test_idle_timeout(self):
+        self.put_file('ff', '1')
+
+        conn = http.client.HTTPConnection('localhost', self.port)
+        self.assertEqual((HTTPStatus.OK, b'1', None),
+                         self.request(conn, 'GET', 'ff'))
+        time.sleep(2)
+        self.assertEqual(b'', conn.sock.recv(1))
+        conn.close()
+
+    def test_small_requests(self):
+        self.put_file('ff', '1')
+
+        conn = http.client.HTTPConnection('localhost', self.port)
+        start = time.monotonic()
+        for i in range(50):
+            conn.request('GET', '/ff')
+            response = conn.getresponse()
+            self.assertEqual(b'1', response.read())
+            if response.getheader('Connection') == 'close':
+                conn.close()
+        # responses are not held back by Nagle's algorithm, which would
+        # delay each of them by the delayed ACK timeout of about 40 ms
+        self.assertLess(time.monotonic() - start, 1)
+        conn.close()
+
+    def test_stalled_headers(self):
+        self.put_file('ff', '1')
+
+        sock = socket.create_connection(('localhost', self.port))
+        sock.settimeout(5)
+        sock.sendall(b'GET /ff HTTP/1.1\r\n')
+        # the connection is closed once the idle timeout expires
+        self.assertEqual(b'', sock.recv(1))
+        sock.close()
+        self.assert_get('ff', HTTPStatus.OK, '1')
+
+    def test_stalled_body(self):
+        self.put_file('ff', '1')
+
+        # as many stalled uploads as there are listener threads
+        socks = []
+        for i in range(2):
+            sock = socket.create_connection(('localhost', self.port))
+            sock.settimeout(5)
+            sock.sendall('PUT /up{0} HTTP/1.1\r\nContent-Length: 100\r\n'
+                         '\r\n1'.format(i).encode())
+            socks.append(sock)
+        for sock in socks:
+            response = b''
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+            self.assertIn(b' 408 ', response.split(b'\r\n')[0])
+            sock.close()
+        r = requests.get('http://localhost:{0}/ff'.format(self.port),
+                         timeout=5)
+        self.assertEqual('1', r.text)
+        self.assert_get('up0', HTTPStatus.NOT_FOUND)
+
+
+class TestKeepAliveAsyncio(TestKeepAlive):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestStalledUploadsAsyncio(TestFixture):
+    server_args = ['--engine', 'asyncio', '--threads', '2',
+                   '--idle_timeout', '3']
+
+    def test_stalled_uploads(self):
+        self.put_file('ff', '1')
+
+        socks = []
+        for i in range(2):
+            sock = socket.create_connection(('localhost', self.port))
+            sock.settimeout(10)
+            sock.sendall('PUT /up{0} HTTP/1.1\r\nContent-Length: 100\r\n'
+                         '\r\n1'.format(i).encode())
+            socks.append(sock)
+        time.sleep(0.5)
+
+        # the stalled uploads occupy all upload threads, but not the threads
+        # used for other requests
+        r = requests.get('http://localhost:{0}/ff'.format(self.port),
+                         timeout=2)
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('1', r.text)
+
+        # the uploads time out once no data arrives within the idle timeout
+        for sock in socks:
+            response = b''
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+            self.assertTrue(response.startswith(b'HTTP/1.0 408 '), response)
+            sock.close()
+        self.assert_get('up0', HTTPStatus.NOT_FOUND)
+        self.assert_put('up0', HTTPStatus.OK, '2')
+
+
+class TestKeepAliveAuth(TestFixture):
+    def setUp(self):
+        perms_json = '''
+{
+    "paths" : [
+        { "path" : ".", "user" : "*", "perms" : "l" }
+    ],
+    "users" : []
+}
+'''
+        super().setUp(perms_json=perms_json, extra_args=['--keep_alive'])
+
+    def test_unauthorized(self):
+        conn = http.client.HTTPConnection('localhost', self.port)
+        for method in ['HEAD', 'GET', 'HEAD']:
+            conn.request(method, '/ff')
+            r = conn.getresponse()
+            self.assertEqual(HTTPStatus.UNAUTHORIZED, r.status)
+            r.read()
+            self.assertIsNone(r.getheader('Connection'))
+
+        conn.request('PUT', '/ff', body=b'1')
+        r = conn.getresponse()
+        self.assertEqual(HTTPStatus.UNAUTHORIZED, r.status)
+        r.read()
+        self.assertEqual('close', r.getheader('Connection'))
+        conn.close()
+
+
+class TestListing(TestFixture):
+    def test_listing_types(self):
+        self.put_file('dir/ff', '1')
+        self.put_dir('dir/subdir')
+        os.symlink('ff', os.path.join(self.root, 'dir/link_file'))
+        os.symlink('subdir', os.path.join(self.root, 'dir/link_dir'))
+        os.symlink('missing', os.path.join(self.root, 'dir/link_missing'))
+        os.mkfifo(os.path.join(self.root, 'dir/fifo'))
+        self.assert_get('dir/', HTTPStatus.OK,
+                        '{"ff": "file", "fifo": "other", '
+                        '"link_dir": "directory", "link_file": "file", '
+                        '"link_missing": "other", "subdir": "directory"}')
+
+    def test_listing_pages(self):
+        for fn in ['a', 'b', 'c', 'd', 'e']:
+            self.put_file('dir/' + fn)
+
+        r = self.get('dir/?limit=2')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('{"a": "file", "b": "file"}', r.text)
+        self.assertEqual('b', r.headers['X-Next-After'])
+
+        r = self.get('dir/?limit=2&after=b')
+        self.assertEqual('{"c": "file", "d": "file"}', r.text)
+        self.assertEqual('d', r.headers['X-Next-After'])
+
+        r = self.get('dir/?limit=2&after=d')
+        self.assertEqual('{"e": "file"}', r.text)
+        self.assertNotIn('X-Next-After', r.headers)
+
+        r = self.get('dir/?after=c')
+        self.assertEqual('{"d": "file", "e": "file"}', r.text)
+
+        for limit in ['x', '0', '-1']:
+            r = self.get('dir/?limit=' + limit)
+            self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+
+    def test_listing_unsorted(self):
+        expected = {'f{0}'.format(i): 'file' for i in range(5000)}
+        for fn in expected:
+            self.put_file('dir/' + fn)
+
+        r = self.get('dir/?sort=0')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual(expected, r.json())
+
+    def test_listing_recursive(self):
+        self.put_file('dir/a', '1')
+        self.put_file('dir/b/c', '22')
+        self.put_file('dir/b/d/e', '333')
+        self.put_dir('dir/f')
+
+        r = self.get('dir/?recursive=1')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('["a", "file"]\n'
+                         '["b", "directory"]\n'
+                         '["f", "directory"]\n'
+                         '["b/c", "file"]\n'
+                         '["b/d", "directory"]\n'
+                         '["b/d/e", "file"]\n', r.text)
+
+        r = self.get('dir/?recursive=1&depth=2')
+        self.assertEqual('["a", "file"]\n'
+                         '["b", "directory"]\n'
+                         '["f", "directory"]\n'
+                         '["b/c", "file"]\n'
+                         '["b/d", "directory"]\n', r.text)
+
+        for depth in ['x', '0', '-1']:
+            r = self.get('dir/?recursive=1&depth=' + depth)
+            self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+
+        r = self.get('dir/b/?recursive=1&details=1')
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual(['c', 'd', 'd/e'], [row[0] for row in rows])
+        self.assertEqual(2, rows[0][2])
+        self.assertEqual(3, rows[2][2])
+        st = os.stat(os.path.join(self.root, 'dir/b/d/e'))
+        self.assertEqual(st.st_mtime_ns, rows[2][3])
+        self.assertEqual(st.st_ino, rows[2][4])
+
+    def test_listing_details(self):
+        self.put_file('dir/a', '1')
+        self.put_file('dir/b', '22')
+        self.put_dir('dir/c')
+
+        r = self.get('dir/?details=1')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('application/x-ndjson', r.headers['Content-Type'])
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual([['a', 'file'], ['b', 'file'], ['c', 'directory']],
+                         [row[:2] for row in rows])
+        for row in rows:
+            st = os.stat(os.path.join(self.root, 'dir', row[0]))
+            self.assertEqual([st.st_size, st.st_mtime_ns, st.st_ino],
+                             row[2:])
+
+        r = self.get('dir/?details=1&limit=1&after=a')
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual(['b'], [row[0] for row in rows])
+        self.assertEqual('b', r.headers['X-Next-After'])
+
+
+class TestListingKeepAlive(TestListing):
+    server_args = ['--keep_alive']
+
+
+class TestListingAsyncio(TestListing):
+    server_args = ['--engine', 'asyncio', '--keep_alive']
+
+
+class TestListingCache(TestFixture):
+    server_args = ['--listing_cache_size', '100000']
+
+    def set_old_mtime(self, path):
+        path = os.path.join(self.root, path)
+        os.utime(path, ns=(0, 1000000000))
+
+    def test_listing_cache(self):
+        self.put_file('dir/a')
+        self.set_old_mtime('dir')
+        self.assert_get('dir/', HTTPStatus.OK, '{"a": "file"}')
+
+        # modifications that keep the mtime are not noticed
+        self.put_file('dir/b')
+        self.set_old_mtime('dir')
+        self.assert_get('dir/', HTTPStatus.OK, '{"a": "file"}')
+        self.assert_get('dir/?limit=10', HTTPStatus.OK,
+                        '{"a": "file", "b": "file"}')
+
+        # uploads invalidate the cache
+        self.assert_put('dir/c', HTTPStatus.OK, '1')
+        self.set_old_mtime('dir')
+        self.assert_get('dir/', HTTPStatus.OK,
+                        '{"a": "file", "b": "file", "c": "file"}')
+
+        # other modifications are noticed via the mtime
+        self.put_file('dir/d')
+        self.assert_get('dir/', HTTPStatus.OK,
+                        '{"a": "file", "b": "file", "c": "file", '
+                        '"d": "file"}')
+
+    def test_listing_cache_parents(self):
+        self.set_old_mtime('')
+        self.assert_get('', HTTPStatus.OK, '{}')
+        self.assert_put('dir/subdir/a', HTTPStatus.OK, '1')
+        self.set_old_mtime('')
+        self.assert_get('', HTTPStatus.OK, '{"dir": "directory"}')
+
+
+class TestListingCacheAsyncio(TestListingCache):
+    server_args = ['--listing_cache_size', '100000', '--engine', 'asyncio']
+
+
+class TestListingCacheStat(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'tmp_tests_dir')
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(os.path.join(self.root, 'dir'))
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        self.addCleanup(os.chdir, cwd)
+
+        sock = server.create_socket('localhost', 0)
+        self.addCleanup(sock.close)
+        self.port = sock.getsockname()[1]
+        httpd = server.ExternalSocketHTTPServer(
+            ('localhost', self.port), server.SimpleHTTPFileServer, sock)
+        httpd.log_file = io.StringIO()
+        httpd.log_headers = False
+        httpd.options = server.ServerOptions()
+        self.listing_cache = server.ListingCache(100000)
+        httpd.listing_cache = self.listing_cache
+        httpd.access_log = None
+        httpd.file_cache = None
+        httpd.compressed_cache = None
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(httpd.shutdown)
+
+    def test_cached_listing_stat(self):
+        path = os.path.join(self.root, 'dir')
+        os.utime(path, ns=(0, 1000000000))
+        url = 'http://localhost:{0}/dir/'.format(self.port)
+        self.assertEqual('{}', requests.get(url).text)
+
+        with unittest.mock.patch('os.stat', wraps=os.stat) as stat_mock:
+            self.assertEqual('{}', requests.get(url).text)
+        calls = [c for c in stat_mock.call_args_list
+                 if os.path.normpath(c[0][0]) == path]
+        # the directory is stat()ed once per cache hit
+        self.assertEqual(1, self.listing_cache.hits)
+        self.assertEqual(1, len(calls))
+
+
+class TestFileCache(TestFixture):
+    server_args = ['--file_cache_size', '100000',
+                   '--file_cache_max_file_size', '100']
+
+    def set_old_mtime(self, path):
+        path = os.path.join(self.root, path)
+        os.utime(path, ns=(0, 1000000000))
+
+    def overwrite_keeping_mtime(self, path, text):
+        # the inode, size and mtime stay the same
+        with open(os.path.join(self.root, path), 'r+') as f:
+            f.write(text)
+        self.set_old_mtime(path)
+
+    def test_file_cache(self):
+        self.put_file('ff', 'abc')
+        self.set_old_mtime('ff')
+        self.assert_get('ff', HTTPStatus.OK, 'abc')
+
+        # modifications that keep the validators are not noticed
+        self.overwrite_keeping_mtime('ff', 'def')
+        self.assert_get('ff', HTTPStatus.OK, 'abc')
+        r = self.head('ff')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('3', r.headers['Content-Length'])
+        self.assertEqual('', r.text)
+        etag = r.headers['ETag']
+        r = self.get('ff', {'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, r.status_code)
+        # ranges are read from the file
+        r = self.get('ff', {'Range': 'bytes=1-'})
+        self.assertEqual('ef', r.text)
+
+        # uploads invalidate the cache
+        self.assert_put('ff', HTTPStatus.OK, 'ghi')
+        self.set_old_mtime('ff')
+        self.assert_get('ff', HTTPStatus.OK, 'ghi')
+
+        # other modifications are noticed via the mtime
+        self.put_file('ff', 'jkl')
+        self.assert_get('ff', HTTPStatus.OK, 'jkl')
+
+    def test_file_cache_large_files(self):
+        self.put_file('ff', 'a' * 101)
+        self.set_old_mtime('ff')
+        self.assert_get('ff', HTTPStatus.OK, 'a' * 101)
+        self.overwrite_keeping_mtime('ff', 'b' * 101)
+        self.assert_get('ff', HTTPStatus.OK, 'b' * 101)
+
+    def test_file_cache_keep_alive(self):
+        self.put_file('ff', 'abc')
+        self.set_old_mtime('ff')
+        conn = http.client.HTTPConnection('localhost', self.port)
+        for i in range(5):
+            conn.request('GET', '/ff')
+            r = conn.getresponse()
+            self.assertEqual(HTTPStatus.OK, r.status)
+            self.assertEqual(b'abc', r.read())
+        conn.close()
+
+
+class TestFileCacheAsyncio(TestFileCache):
+    server_args = ['--file_cache_size', '100000',
+                   '--file_cache_max_file_size', '100', '--engine', 'asyncio']
+
+
+class TestFileCacheKeepAlive(TestFileCache):
+    server_args = ['--file_cache_size', '100000',
+                   '--file_cache_max_file_size', '100', '--keep_alive']
+
+
+class TestCompression(TestFixture):
+    server_args = ['--precompressed', '--compress', '--listing_cache_size',
+                   '100000']
+
+    def raw_get(self, path, headers=None):
+        conn = http.client.HTTPConnection('localhost', self.port)
+        conn.request('GET', '/' + path, headers=headers or {})
+        r = conn.getresponse()
+        body = r.read()
+        conn.close()
+        return r, body
+
+    def set_mtime(self, path, mtime):
+        path = os.path.join(self.root, path)
+        os.utime(path, ns=(0, mtime * 1000000000))
+
+    def test_listing(self):
+        self.put_file('dir/a')
+        self.set_mtime('dir', 1)
+        for i in range(2):
+            # the second listing comes from the cache
+            r, body = self.raw_get('dir/', {'Accept-Encoding': 'gzip'})
+            self.assertEqual(HTTPStatus.OK, r.status)
+            self.assertEqual('gzip', r.getheader('Content-Encoding'))
+            self.assertEqual(b'{"a": "file"}', gzip.decompress(body))
+
+        r, body = self.raw_get('dir/', {'Accept-Encoding': 'gzip;q=0'})
+        self.assertIsNone(r.getheader('Content-Encoding'))
+        self.assertEqual(b'{"a": "file"}', body)
+
+        r, body = self.raw_get('dir/?recursive=1',
+                               {'Accept-Encoding': 'br, gzip'})
+        self.assertEqual('gzip', r.getheader('Content-Encoding'))
+        self.assertEqual(b'["a", "file"]\n', gzip.decompress(body))
+
+    def test_precompressed(self):
+        self.put_file('ff', 'original')
+        self.put_file('ff.gz', 'gzip')
+        self.put_file('ff.br', 'brotli')
+        self.set_mtime('ff', 2)
+        self.set_mtime('ff.gz', 2)
+        self.set_mtime('ff.br', 1)
+
+        r, body = self.raw_get('ff', {'Accept-Encoding': 'gzip, br'})
+        self.assertEqual('gzip', r.getheader('Content-Encoding'))
+        self.assertEqual('Accept-Encoding', r.getheader('Vary'))
+        self.assertEqual(b'gzip', body)
+        r, body = self.raw_get('ff', {'Accept-Encoding': 'gzip;q=0, br'})
+        self.assertIsNone(r.getheader('Content-Encoding'))
+        self.assertEqual(b'original', body)
+
+        self.set_mtime('ff.br', 3)
+        r, body = self.raw_get('ff', {'Accept-Encoding': 'gzip, br'})
+        self.assertEqual('br', r.getheader('Content-Encoding'))
+        self.assertEqual(b'brotli', body)
+
+        r, body = self.raw_get('ff')
+        self.assertIsNone(r.getheader('Content-Encoding'))
+        self.assertEqual(b'original', body)
+
+    def test_compress(self):
+        self.put_file('text', 'a' * 1000)
+        self.put_file('random')
+        with open(os.path.join(self.root, 'random'), 'wb') as f:
+            f.write(os.urandom(1000))
+
+        r, body = self.raw_get('text', {'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', r.getheader('Content-Encoding'))
+        self.assertEqual(b'a' * 1000, gzip.decompress(body))
+        self.assertIsNone(r.getheader('Accept-Ranges'))
+        etag = r.getheader('ETag')
+
+        r, body = self.raw_get('text', {'Accept-Encoding': 'gzip',
+                                        'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, r.status)
+
+        r, body = self.raw_get('text')
+        self.assertIsNone(r.getheader('Content-Encoding'))
+        self.assertNotEqual(etag, r.getheader('ETag'))
+        self.assertEqual(b'a' * 1000, body)
+
+        r, body = self.raw_get('text', {'Accept-Encoding': 'gzip',
+                                        'Range': 'bytes=0-9'})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, r.status)
+        self.assertIsNone(r.getheader('Content-Encoding'))
+        self.assertEqual(b'a' * 10, body)
+
+        r, body = self.raw_get('random', {'Accept-Encoding': 'gzip'})
+        self.assertIsNone(r.getheader('Content-Encoding'))
+        self.assertEqual(1000, len(body))
+
+        # uploads replace the compressed variant
+        self.assert_put('text', HTTPStatus.OK, 'b' * 1000)
+        r, body = self.raw_get('text', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(b'b' * 1000, gzip.decompress(body))
+
+
+class TestCompressionAsyncio(TestCompression):
+    server_args = ['--precompressed', '--compress', '--listing_cache_size',
+                   '100000', '--engine', 'asyncio']
+
+
+class TestArchive(TestFixture):
+
+    def make_tree(self):
+        self.put_file('dir/a', 'aaa')
+        self.put_file('dir/sub/b', 'b' * 100000)
+        self.put_dir('dir/empty')
+        self.put_file('other', 'not archived')
+
+    def test_tar(self):
+        self.make_tree()
+        r = self.get('dir/?archive=tar')
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual('application/x-tar', r.headers['Content-type'])
+        self.assertEqual("attachment; filename*=UTF-8''dir.tar",
+                         r.headers['Content-Disposition'])
+        self.assertEqual(0, len(r.content) % tarfile.RECORDSIZE)
+
+        with tarfile.open(fileobj=io.BytesIO(r.content)) as archive:
+            self.assertEqual(['a', 'empty', 'sub', 'sub/b'],
+                             sorted(archive.getnames()))
+            self.assertTrue(archive.getmember('empty').isdir())
+            self.assertEqual(b'aaa', archive.extractfile('a').read())
+            self.assertEqual(b'b' * 100000,
+                             archive.extractfile('sub/b').read())
+
+    def test_tar_gz(self):
+        self.make_tree()
+        r = self.get('dir/?archive=tar.gz')
+        self.assertEqual('application/gzip', r.headers['Content-type'])
+        with tarfile.open(fileobj=io.BytesIO(gzip.decompress(r.content))) \
+                as archive:
+            self.assertEqual(['a', 'empty', 'sub', 'sub/b'],
+                             sorted(archive.getnames()))
+            self.assertEqual(b'b' * 100000,
+                             archive.extractfile('sub/b').read())
+
+    def test_zip(self):
+        self.make_tree()
+        r = self.get('dir/?archive=zip')
+        self.assertEqual('application/zip', r.headers['Content-type'])
+        with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(['a', 'empty/', 'sub/', 'sub/b'],
+                             sorted(archive.namelist()))
+            self.assertEqual(b'aaa', archive.read('a'))
+            self.assertEqual(b'b' * 100000, archive.read('sub/b'))
+
+    def test_unsupported_format(self):
+        self.put_dir('dir')
+        r = self.get('dir/?archive=rar')
+        self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+
+
+class TestArchiveAsyncio(TestArchive):
+    server_args = ['--engine', 'asyncio', '--keep_alive']
+
+
+class TestBulkUpload(TestFixture):
+
+    def make_tar(self, files, mode='w'):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode=mode) as archive:
+            for name, text in files:
+                info = tarfile.TarInfo(name)
+                if text is None:
+                    info.type = tarfile.DIRTYPE
+                    archive.addfile(info)
+                    continue
+                text = text.encode('utf-8')
+                info.size = len(text)
+                archive.addfile(info, io.BytesIO(text))
+        return data.getvalue()
+
+    def put(self, path, data, headers=None):
+        url = "http://localhost:" + str(self.port) + "/" + path
+        return requests.put(url, data=data, headers=headers)
+
+    def test_extract(self):
+        self.put_file('dir/a', 'old')
+        data = self.make_tar([('a', 'new'), ('sub/b', 'b' * 100000),
+                              ('./empty/', None)])
+        r = self.put('dir/?extract=tar', data)
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assert_get_path('dir/a', 'new')
+        self.assert_get_path('dir/sub/b', 'b' * 100000)
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'dir/empty')))
+        self.assertEqual(['a', 'empty', 'sub'],
+                         sorted(os.listdir(os.path.join(self.root, 'dir'))))
+
+    def test_extract_gz_chunked(self):
+        data = self.make_tar([('a', 'aaa'), ('b/c', 'ccc')], 'w:gz')
+        r = self.put('new/?extract=tar',
+                     (data[i:i + 100] for i in range(0, len(data), 100)))
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assert_get_path('new/a', 'aaa')
+        self.assert_get_path('new/b/c', 'ccc')
+
+    def test_skips_links(self):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as archive:
+            info = tarfile.TarInfo('link')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            archive.addfile(info)
+        r = self.put('dir/?extract=tar', data.getvalue())
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assertEqual([], os.listdir(os.path.join(self.root, 'dir')))
+
+    def test_path_traversal(self):
+        for name in ['../evil', '/evil', 'a/../../evil']:
+            data = self.make_tar([('ok/a', 'a'), (name, 'evil')])
+            r = self.put('dir/?extract=tar', data)
+            self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+            self.assertEqual([], os.listdir(self.root))
+
+    def test_truncated(self):
+        self.put_file('dir/a', 'old')
+        data = self.make_tar([('a', 'new'), ('b', 'b' * 100000)])
+        r = self.put('dir/?extract=tar', data[:50000])
+        self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+        self.assert_get_path('dir/a', 'old')
+        self.assertEqual(['a'], os.listdir(os.path.join(self.root, 'dir')))
+
+    def test_invalid_targets(self):
+        self.put_file('file')
+        data = self.make_tar([('a', 'a')])
+        r = self.put('file?extract=tar', data)
+        self.assertEqual(HTTPStatus.METHOD_NOT_ALLOWED, r.status_code)
+        r = self.put('dir/?extract=zip', data)
+        self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+
+        self.put_dir('dir/a')
+        r = self.put('dir/?extract=tar', self.make_tar([('b', 'b'),
+                                                        ('a', 'a')]))
+        self.assertEqual(HTTPStatus.METHOD_NOT_ALLOWED, r.status_code)
+        self.assertEqual(['a'], os.listdir(os.path.join(self.root, 'dir')))
+
+
+class TestBulkUploadAsyncio(TestBulkUpload):
+    server_args = ['--engine', 'asyncio', '--keep_alive']
+
+
+class TestUploadDigests(TestFixture):
+    server_args = ['--store_digests']
+
+    def put(self, path, data, headers=None):
+        url = "http://localhost:" + str(self.port) + "/" + path
+        return requests.put(url, data=data, headers=headers)
+
+    def test_verify(self):
+        data = b'data' * 1000
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+        sha256 = hashlib.sha256(data)
+        sha256_b64 = base64.b64encode(sha256.digest()).decode()
+        for headers in [{'Content-MD5': md5},
+                        {'Digest': 'unknown=abc, SHA-256=' + sha256_b64},
+                        {'X-Checksum-Sha256': sha256.hexdigest()}]:
+            r = self.put('file', data, headers)
+            self.assertEqual(HTTPStatus.OK, r.status_code)
+
+        r = self.put('chunked', (data[i:i + 100]
+                                 for i in range(0, len(data), 100)),
+                     {'Content-MD5': md5})
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assert_get_path('chunked', data.decode())
+
+    def test_mismatch(self):
+        self.put_file('file', 'old')
+        wrong = hashlib.sha256(b'other').hexdigest()
+        for headers in [{'X-Checksum-Sha256': wrong},
+                        {'Content-MD5': 'AAAAAAAAAAAAAAAAAAAAAA=='},
+                        {'Digest': 'md5=AAAAAAAAAAAAAAAAAAAAAA=='}]:
+            for path in ['file', 'new']:
+                r = self.put(path, b'new', headers)
+                self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+        self.assert_get_path('file', 'old')
+        self.assertEqual(['file'], os.listdir(self.root))
+
+        for headers in [{'Content-MD5': 'not base64!'},
+                        {'X-Checksum-Sha256': 'xyz'},
+                        {'Digest': 'sha-256'}]:
+            r = self.put('file', b'new', headers)
+            self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+        self.assert_get_path('file', 'old')
+
+    def test_stored_digest(self):
+        data = b'data' * 1000
+        sha256 = hashlib.sha256(data)
+        r = self.put('file', data)
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+
+        for i in range(2):
+            for r in [self.get('file'), self.head('file')]:
+                self.assertEqual(sha256.hexdigest(),
+                                 r.headers['X-Checksum-Sha256'])
+                self.assertEqual(
+                    'sha-256=' + base64.b64encode(sha256.digest()).decode(),
+                    r.headers['Digest'])
+
+        # digests of files changed without the server are not returned
+        self.put_file('file', 'changed')
+        r = self.get('file')
+        self.assertEqual('changed', r.text)
+        self.assertNotIn('X-Checksum-Sha256', r.headers)
+
+    def test_bulk_upload(self):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as archive:
+            info = tarfile.TarInfo('a')
+            info.size = 3
+            archive.addfile(info, io.BytesIO(b'aaa'))
+        data = data.getvalue()
+
+        r = self.put('dir/?extract=tar', data,
+                     {'X-Checksum-Sha256': hashlib.sha256(b'').hexdigest()})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, r.status_code)
+        self.assertEqual([], os.listdir(self.root))
+
+        r = self.put('dir/?extract=tar', data,
+                     {'X-Checksum-Sha256': hashlib.sha256(data).hexdigest()})
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        r = self.get('dir/a')
+        self.assertEqual(hashlib.sha256(b'aaa').hexdigest(),
+                         r.headers['X-Checksum-Sha256'])
+
+
+class TestUploadDigestsAsyncio(TestUploadDigests):
+    server_args = ['--store_digests', '--engine', 'asyncio', '--keep_alive']
+
+
+class TestUploadDigestsFileCache(TestUploadDigests):
+    server_args = ['--store_digests', '--file_cache_size', '100000']
+
+
+class TestNoAuthAsyncio(TestNoAuth):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestConditionalAsyncio(TestConditional):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestKeepAliveAuthAsyncio(TestKeepAliveAuth):
+    server_args = ['--engine', 'asyncio']
+
+
+class TestAuthRecursiveListing(TestFixture):
+
+    def setUp(self):
+        perms_json = '''
+{
+    "paths" : [
+        { "path" : ".", "user" : "*", "perms" : "l" },
+        { "path" : "a/hidden", "user" : "*", "perms" : "" },
+        { "path" : "a/hidden/visible", "user" : "*", "perms" : "l" },
+        { "path" : "a/user", "user" : "*", "perms" : "" },
+        { "path" : "a/user", "user" : "user1", "perms" : "l" }
+    ],
+    "users" : [
+        { "user" : "user1", "psw" : "pass1" }
+    ]
+}
+'''
+        super().setUp(perms_json=perms_json)
+
+    def test_recursive_listing(self):
+        self.put_file('a/f')
+        self.put_file('a/hidden/f')
+        self.put_file('a/hidden/visible/f')
+        self.put_file('a/user/f')
+
+        r = self.get('a/?recursive=1')
+        self.assertEqual('["f", "file"]\n'
+                         '["hidden", "directory"]\n'
+                         '["user", "directory"]\n', r.text)
+
+        url = "http://localhost:" + str(self.port) + "/a/?recursive=1"
+        r = requests.get(url, auth=('user1', 'pass1'))
+        self.assertEqual('["f", "file"]\n'
+                         '["hidden", "directory"]\n'
+                         '["user", "directory"]\n'
+                         '["user/f", "file"]\n', r.text)
+
+        r = self.get('a/hidden/?recursive=1')
+        self.assertEqual(HTTPStatus.UNAUTHORIZED, r.status_code)
+        r = self.get('a/hidden/visible/?recursive=1')
+        self.assertEqual('["f", "file"]\n', r.text)
+
+
+class TestAuthArchive(TestFixture):
+
+    def setUp(self):
+        perms_json = '''
+{
+    "paths" : [
+        { "path" : ".", "user" : "*", "perms" : "rl" },
+        { "path" : "a/secret", "user" : "*", "perms" : "l" },
+        { "path" : "a/hidden", "user" : "*", "perms" : "r" },
+        { "path" : "a/user", "user" : "*", "perms" : "" },
+        { "path" : "a/user", "user" : "user1", "perms" : "rl" }
+    ],
+    "users" : [
+        { "user" : "user1", "psw" : "pass1" }
+    ]
+}
+'''
+        super().setUp(perms_json=perms_json)
+
+    def get_names(self, auth=None):
+        url = "http://localhost:" + str(self.port) + "/a/?archive=tar"
+        r = requests.get(url, auth=auth)
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        with tarfile.open(fileobj=io.BytesIO(r.content)) as archive:
+            return sorted(archive.getnames())
+
+    def test_archive(self):
+        self.put_file('a/f', 'f')
+        self.put_file('a/secret', 'secret')
+        self.put_file('a/hidden/f', 'f')
+        self.put_file('a/user/f', 'f')
+
+        self.assertEqual(['f', 'hidden', 'user'], self.get_names())
+        self.assertEqual(['f', 'hidden', 'user', 'user/f'],
+                         self.get_names(('user1', 'pass1')))
+
+
+class TestAuthBulkUpload(TestFixture):
+
+    def setUp(self):
+        perms_json = '''
+{
+    "paths" : [
+        { "path" : ".", "user" : "*", "perms" : "rl" },
+        { "path" : "a", "user" : "user1", "perms" : "rwl" },
+        { "path" : "a/ro", "user" : "user1", "perms" : "rl" }
+    ],
+    "users" : [
+        { "user" : "user1", "psw" : "pass1" }
+    ]
+}
+'''
+        super().setUp(perms_json=perms_json)
+
+    def put_tar(self, names, auth=None):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as archive:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = 1
+                archive.addfile(info, io.BytesIO(b'x'))
+        url = "http://localhost:" + str(self.port) + "/a/?extract=tar"
+        return requests.put(url, data=data.getvalue(), auth=auth)
+
+    def test_bulk_upload(self):
+        self.put_dir('a')
+        r = self.put_tar(['f'])
+        self.assertEqual(HTTPStatus.UNAUTHORIZED, r.status_code)
+
+        r = self.put_tar(['f', 'ro/f'], ('user1', 'pass1'))
+        self.assertEqual(HTTPStatus.FORBIDDEN, r.status_code)
+        self.assertEqual([], os.listdir(os.path.join(self.root, 'a')))
+
+        r = self.put_tar(['f', 'sub/f'], ('user1', 'pass1'))
+        self.assertEqual(HTTPStatus.OK, r.status_code)
+        self.assert_get_path('a/f', 'x')
+        self.assert_get_path('a/sub/f', 'x')
+
+
+class TestHashedPasswords(TestFixture):
+
+    def setUp(self):
+        perms_json = json.dumps({
+            'paths': [
+                {'path': '.', 'user': '*', 'perms': ''},
+                {'path': '.', 'user': 'user1', 'perms': 'rwl'},
+                {'path': '.', 'user': 'user2', 'perms': 'rl'},
+                {'path': '.', 'user': 'user3', 'perms': 'rl'},
+            ],
+            'users': [
+                {'user': 'user1',
+                 'psw_hash': server.hash_password('pass1')},
+                {'user': 'user2',
+                 'psw_hash': server.hash_password('pass2', 'pbkdf2_sha256')},
+                {'user': 'user3', 'psw': 'pass3'},
+            ]
+        })
+        super().setUp(perms_json=perms_json)
+
+    def test_hash_format(self):
+        for method in ['scrypt', 'pbkdf2_sha256']:
+            h = server.PasswordHash(server.hash_password('pass', method))
+            self.assertTrue(h.verify('pass'))
+            self.assertFalse(h.verify('pas'))
+        self.assertRaises(ValueError, server.hash_password, 'pass', 'md5')
+        self.assertRaises(ValueError, server.PasswordHash, 'scrypt$1$2$abc')
+
+    def test_hashed_passwords(self):
+        self.assert_put("ff", HTTPStatus.UNAUTHORIZED, "1")
+        self.assert_put("ff", HTTPStatus.OK, "1", user='user1', psw='pass1')
+        self.assert_put("ff", HTTPStatus.UNAUTHORIZED, "1",
+                        user='user1', psw='pass2')
+        self.assert_put("ff", HTTPStatus.UNAUTHORIZED, "1",
+                        user='user2', psw='pass2')
+        for i in range(3):
+            # repeated requests are served from the credential cache
+            self.assert_get("ff", HTTPStatus.OK, "1",
+                            user='user2', psw='pass2')
+            self.assert_get("ff", HTTPStatus.UNAUTHORIZED,
+                            user='user2', psw='pass1')
+        self.assert_get("ff", HTTPStatus.OK, "1", user='user3', psw='pass3')
+        self.assert_get("ff", HTTPStatus.UNAUTHORIZED,
+                        user='user3', psw='pass1')
+
+    def test_malformed_header(self):
+        for value in ['Basic !!!', 'Basic ' + 'dXNlcjE=', 'Bearer abc']:
+            r = self.get('', headers={'Authorization': value})
+            self.assertEqual(HTTPStatus.UNAUTHORIZED, r.status_code)
+
+
+class TestAccessConfigReload(TestFixture):
+
+    def make_perms_json(self, perms):
+        return json.dumps({
+            'paths': [{'path': '.', 'user': '*', 'perms': perms}],
+            'users': []
+        })
+
+    def setUp(self):
+        self.log_path = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'tmp_tests_dir', 'log.txt')
+        super().setUp(perms_json=self.make_perms_json('l'),
+                      extra_args=['--log', self.log_path,
+                                  '--should_flush_log'])
+        self.perm_path = os.path.join(os.path.dirname(self.root),
+                                      "tmp_tests_perms.json")
+
+    def write_perms(self, text):
+        with open(self.perm_path + '.new', 'w') as file:
+            file.write(text)
+        os.replace(self.perm_path + '.new', self.perm_path)
+
+    def reload(self):
+        self.process.send_signal(signal.SIGHUP)
+
+    def wait_for_status(self, path, expected_status):
+        for i in range(50):
+            # with several workers each of them needs to have reloaded
+            statuses = [self.get(path).status_code for j in range(5)]
+            if statuses == [expected_status] * 5:
+                return
+            time.sleep(0.1)
+        self.fail('Access config was not reloaded')
+
+    def wait_for_log(self, text):
+        for i in range(50):
+            with open(self.log_path) as f:
+                if text in f.read():
+                    return
+            time.sleep(0.1)
+        self.fail('Not logged: ' + text)
+
+    def test_reload(self):
+        self.put_file('ff', '1')
+        self.assert_get('ff', HTTPStatus.UNAUTHORIZED)
+
+        self.write_perms(self.make_perms_json('rl'))
+        self.reload()
+        self.wait_for_status('ff', HTTPStatus.OK)
+        self.wait_for_log('Reloaded access config')
+
+        # a broken config file does not replace the working one
+        self.write_perms('{ "paths" : [')
+        self.reload()
+        self.wait_for_log('Error reading access config')
+        self.assert_get('ff', HTTPStatus.OK, '1')
+
+        self.write_perms(self.make_perms_json(''))
+        self.reload()
+        self.wait_for_status('ff', HTTPStatus.UNAUTHORIZED)
+
+
+class TestAccessConfigReloadPoll(TestAccessConfigReload):
+    server_args = ['--access_config_poll_interval', '0.1']
+
+    def reload(self):
+        pass
+
+
+class TestAccessConfigReloadWorkers(TestAccessConfigReload):
+    server_args = ['--workers', '2', '--engine', 'asyncio']
+
+    def get_worker_pids(self):
+        output = subprocess.check_output(['pgrep', '-P',
+                                          str(self.process.pid)])
+        return [int(pid) for pid in output.split()]
+
+    def test_restarted_worker(self):
+        self.put_file('ff', '1')
+        self.write_perms(self.make_perms_json('rl'))
+        self.reload()
+        self.wait_for_status('ff', HTTPStatus.OK)
+
+        pids = self.get_worker_pids()
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+        for i in range(50):
+            time.sleep(0.1)
+            new_pids = self.get_worker_pids()
+            if len(new_pids) == 2 and not set(pids) & set(new_pids):
+                break
+        else:
+            self.fail('Workers were not restarted')
+        # the restarted workers don't go back to the startup config
+        for i in range(10):
+            self.assert_get('ff', HTTPStatus.OK, '1')
+
+
 class TestAuthNoneAllowed(TestFixture):
 
     def setUp(self):
@@ -534,3 +2363,7 @@ class TestComplexPermissions(TestFixture):
                         user='user2', psw='pass2')
         self.assert_get("other", HTTPStatus.UNAUTHORIZED,
                         user='user2', psw='p')
+
+
+class TestComplexPermissionsAsyncio(TestComplexPermissions):
+    server_args = ['--engine', 'asyncio']